@@ -1,79 +1,47 @@
-from helpers import fetchone, fetchall
+from helpers import query
+from notifications import notify_change
+from challenge_calendar import get_calendar
+from scores import CHALLENGE_POINTS, refresh_week_score
 from datetime import datetime, timedelta, date
 import pytz
 import logging
 import itertools
+from typing import Dict, List, NamedTuple, Optional
+from decimal import Decimal
+import json
 
 
+@query()
 def points_so_far(challenge_id):
-    return fetchall("select * from get_challenge_score(%s, FALSE)", [challenge_id])
-
-
-def get_challenges():
-    return fetchall("select * from challenges")
-
-
-def bi_checkins(challenge_id):
-    sql = "select sum(bi_checkins) from challenger_challenges where challenge_id = %s"
-    return fetchone(sql, [challenge_id]).sum
-
-
-def points_knocked_out(challenge_id):
-    return fetchall("select * from get_challenge_score(%s, TRUE)", [challenge_id])
-
-
-def challenge_data(challenge_id):
-    return fetchone("select * from challenges where id = %s;", [challenge_id])
-
-
-def total_ante(challenge_id, tier):
-    return fetchone(
-        "select sum(ante) from challenger_challenges where challenge_id = %s and tier = %s",
-        (challenge_id, tier),
-    ).sum
+    return CHALLENGE_POINTS, (challenge_id, challenge_id, False)
 
 
 def total_possible_checkins_so_far(challenge_id, week_id):
-    sql = "select count(*) * 5 as total_possible from challenge_weeks where challenge_id = %s and id < %s;"
-    checkins_possible_before_now = fetchone(sql, (challenge_id, week_id))[0]
-    now = datetime.now()
-    day_of_week = now.weekday()
-    return checkins_possible_before_now + min(day_of_week + 1, 5)
+    return get_calendar().possible_checkins_so_far(challenge_id, week_id)
 
 
 def total_possible_checkins(challenge_id):
-    sql = "select count(*) * 5 as total_possible from challenge_weeks where challenge_id = %s;"
-    return fetchone(sql, [challenge_id])
+    return get_calendar().possible_checkins(challenge_id)
 
 
 def challenge_weeks():
-    sql = """
-        select c.name, cw.id, cw.start from challenge_weeks cw
-        join challenges c on cw.challenge_id = c.id
-        order by cw.start
-        """
-    challenges = fetchall(sql, [])
-    return [
-        list(value) for n, value in itertools.groupby(challenges, key=lambda x: x.name)
-    ]
+    return get_calendar().week_options
+
+
+@query(one=True)
+def get_challenge_week(week_id):
+    return "select * from challenge_weeks where id = %s", [week_id]
 
 
 def get_current_challenge_week(tz="America/New_York"):
-    sql = """
-        select * from challenge_weeks 
-        where 
-            week_of_year = extract(week from current_timestamp at time zone %s) and
-            extract(year from start) = extract(year from current_date)
-        """
-    return fetchone(sql, [tz])
+    return get_calendar().week_at(tz=tz)
 
 
 def get_current_challenge():
-    return fetchone(
-        'select * from challenges where start <= CURRENT_DATE and "end" >= CURRENT_DATE'
-    )
+    return get_calendar().challenge_at()
 
 
+@query()
 def checkins_this_week(challenge_week_id):
     sql = """
     select
@@ -93,7 +61,7 @@ def checkins_this_week(challenge_week_id):
        where challenge_week_id = %s
        group by day_of_week, challenger) as max_time_per_day
     join checkins c on
-      c.challenger = max_time_per_day.challenger 
+      c.challenger = max_time_per_day.challenger
       and
       c.time = max_time_per_day.time
       and
@@ -109,28 +77,268 @@ def checkins_this_week(challenge_week_id):
     group by c.id, ch.name, c.day_of_week, c.tier, c.time, cw.bye_week, ch.tz, cch.mulligan
     order by time desc;
     """
-    return fetchall(sql, (challenge_week_id, challenge_week_id))
+    return sql, (challenge_week_id, challenge_week_id)
+
+
+@query(one=True)
+def challenge_validators(challenge_id, week_id=None):
+    """Last checkin time and a version string for one challenge and, optionally,
+    one of its weeks. Only touches that challenge's rows, so a page for an old
+    challenge stays cacheable while checkins keep arriving."""
+    sql = """
+    with challenge_checkins as (
+      select max(c.time) as last_modified, max(c.id) as last_id, count(*) as total
+      from checkins c
+      join challenge_weeks cw on cw.id = c.challenge_week_id
+      where cw.challenge_id = %(challenge_id)s::int
+    ),
+    challenger_state as (
+      select string_agg(
+        concat_ws('/',
+          cc.challenger_id, cc.mulligan, cc.knocked_out,
+          cc.tier, cc.ante, cc.bi_checkins
+        ),
+        ',' order by cc.challenger_id
+      ) as state
+      from challenger_challenges cc
+      where cc.challenge_id = %(challenge_id)s::int
+    )
+    select
+      cc.last_modified,
+      concat_ws(':',
+        %(challenge_id)s::int,
+        cc.last_id,
+        cc.total,
+        (select concat_ws('/', id, green, bye_week)
+         from challenge_weeks where id = %(week_id)s::int),
+        (select concat_ws('/', rule_set, bi_weeks)
+         from challenges where id = %(challenge_id)s::int),
+        cs.state,
+        current_date
+      ) as version
+    from challenge_checkins cc, challenger_state cs
+    """
+    return sql, {"challenge_id": challenge_id, "week_id": week_id}
+
+
+class Score(NamedTuple):
+    points: Decimal
+    name: str
+    tier: str
+
+
+class Pot(NamedTuple):
+    """One tier's share of the antes and how it's paid out per point"""
+
+    scores: List[Score]
+    points: Decimal
+    ante: int
+    dollars_per_point: Decimal
+    payout: int
+
+
+class ChallengeDetails(NamedTuple):
+    pots: Dict[str, Pot]
+    knocked_out: List[Score]
+
+
+def build_challenge_details(row):
+    details = json.loads(row.details)
+    scores = [
+        (Score(Decimal(points), name, tier), knocked_out)
+        for points, name, tier, knocked_out in details["scores"] or []
+    ]
+    antes = details["antes"] or {}
+    pots = {}
+    for tier in ("T2", "T3", "floating"):
+        tier_scores = [s for s, knocked_out in scores if s.tier == tier and not knocked_out]
+        points = sum(s.points for s in tier_scores)
+        if tier == "floating":
+            # bi checkins come out of the floating pot
+            points -= details["bi_checkins"] or 0
+        ante = antes.get(tier)
+        dollars_per_point = ante / points if points > 0 else 0
+        pots[tier] = Pot(
+            tier_scores, points, ante, dollars_per_point, int(dollars_per_point * points)
+        )
+    return ChallengeDetails(pots, [s for s, knocked_out in scores if knocked_out])
+
+
+@query(one=True, post=build_challenge_details)
+def challenge_details(challenge_id):
+    """Everything /details shows for a challenge in one round trip: each
+    challenger's points (at most five days a week) with their tier and whether
+    they were knocked out, the antes per tier and the bi checkins.
+
+    It comes back as one JSON document; build_challenge_details reads points
+    as Decimals, as they were when they came from numeric columns, so payouts
+    work out to the cent as before.
+    """
+    sql = """
+    with challenger_points as (
+      select challenger_id, sum(capped_days) as points
+      from challenger_week_scores
+      where challenge_id = %(challenge_id)s::int
+      group by challenger_id
+    ),
+    scores as (
+      select p.points, ch.name, cc.tier, cc.knocked_out
+      from challenger_points p
+      join challenger_challenges cc
+        on cc.challenger_id = p.challenger_id
+        and cc.challenge_id = %(challenge_id)s::int
+      join challengers ch on ch.id = p.challenger_id
+      where cc.ante > 0 and cc.tier != 'T0' and cc.knocked_out is not null
+    ),
+    antes as (
+      select tier, sum(ante) as ante
+      from challenger_challenges
+      where challenge_id = %(challenge_id)s::int and tier is not null
+      group by tier
+    )
+    select json_build_object(
+      'scores', (
+        select json_agg(
+          json_build_array(points, name, tier, knocked_out)
+          order by points desc, name
+        )
+        from scores
+      ),
+      'antes', (select json_object_agg(tier, ante) from antes),
+      'bi_checkins', (
+        select sum(bi_checkins)
+        from challenger_challenges
+        where challenge_id = %(challenge_id)s::int
+      )
+    )::text as details
+    """
+    return sql, {"challenge_id": challenge_id}
+
+
+class DayCheckin(NamedTuple):
+    day_of_week: str
+    tier: str
+    time: datetime
+    ismulligan: bool
+
+
+class Participant(NamedTuple):
+    name: str
+    hasMulliganed: bool
+    knockedOut: bool
+    checkins: List[DayCheckin]
+
+
+class WeekView(NamedTuple):
+    week_id: int
+    challenge_id: int
+    green: Optional[bool]
+    bye_week: Optional[bool]
+    latest: Optional[datetime]
+    participants: List[Participant]
+
+
+def build_week_view(rows):
+    if len(rows) == 0:
+        return None
+    first = rows[0]
+    participants = []
+    for name, group in itertools.groupby(rows, key=lambda r: r.name):
+        if name is None:
+            continue
+        group = list(group)
+        participants.append(
+            Participant(
+                name,
+                group[0].has_mulliganed,
+                group[0].knocked_out,
+                [
+                    DayCheckin(r.day_of_week, r.tier, r.time, r.ismulligan)
+                    for r in group
+                    if r.day_of_week is not None
+                ],
+            )
+        )
+    return WeekView(
+        first.week_id,
+        first.challenge_id,
+        first.green,
+        first.bye_week,
+        first.latest,
+        participants,
+    )
+
+
+@query(post=build_week_view)
+def week_view(challenge_week_id):
+    """Everything the heat map needs for a week in one round trip: a row per
+    participant per day they checked in (their latest checkin that day), a
+    single row with null checkin columns for participants who haven't checked
+    in yet, and a bare week row if the challenge has no participants.
+
+    Days and times are the challenger's where they checked in, the same
+    local_date the scores are built from."""
+    sql = """
+    with latest_per_day as (
+      select distinct on (c.challenger, c.local_date)
+        c.id, c.challenger, c.local_date, c.tier, c.time, c.tz
+      from checkins c
+      where c.challenge_week_id = %s
+      order by c.challenger, c.local_date, c.time desc
+    )
+    select
+      ch.name,
+      cw.id as week_id,
+      cw.challenge_id,
+      cw.green,
+      cw.bye_week,
+      cc.mulligan is not null as has_mulliganed,
+      coalesce(cc.knocked_out, false) as knocked_out,
+      to_char(l.local_date, 'FMDay') as day_of_week,
+      l.tier,
+      l.time at time zone coalesce(l.tz, 'America/New_York') as time,
+      coalesce(l.id = cc.mulligan, false) as ismulligan,
+      (select time at time zone 'America/New_York'
+       from checkins order by time desc limit 1) as latest
+    from challenge_weeks cw
+    left join (
+      challenger_challenges cc join challengers ch on ch.id = cc.challenger_id
+    ) on cc.challenge_id = cw.challenge_id
+    left join latest_per_day l on l.challenger = ch.id
+    where cw.id = %s
+    order by l.id is null, ch.name, l.time desc;
+    """
+    return sql, (challenge_week_id, challenge_week_id)
 
 
 def insert_checkin(message, tier, challenger, week_id, day_of_week=None, time=None):
-    tz = pytz.timezone(challenger.tz)
-    now = datetime.now(tz=tz)
-    logging.info("now %s", now)
+    if time is None:
+        time = datetime.now(tz=pytz.timezone(challenger.tz))
+        logging.info("now %s", time)
 
     def fn(conn, cur):
         cur.execute(
-            "INSERT INTO checkins (name, time, tier, day_of_week, text, challenge_week_id, challenger, tz) VALUES (%s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING returning id",
+            "INSERT INTO checkins (name, time, tier, day_of_week, text, challenge_week_id, challenger, tz) VALUES (%s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT (challenger, time) DO NOTHING returning id",
             (
                 challenger.name,
-                time or now,
+                time,
                 tier,
-                day_of_week or now.strftime("%A"),
+                day_of_week or time.strftime("%A"),
                 message,
                 week_id,
                 challenger.id,
                 challenger.tz,
             ),
         )
-        return cur.fetchone().id
+        checkin = cur.fetchone()
+        if checkin is None:
+            # already checked in at exactly this time, nothing changed
+            logging.info("checkin for %s at %s already exists", challenger.name, time)
+            return None
+        refresh_week_score(cur, challenger.id, week_id)
+        notify_change(
+            cur, "checkins", challenge_week_id=week_id, challenger_id=challenger.id
+        )
+        return checkin.id
 
     return fn
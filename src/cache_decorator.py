@@ -1,28 +1,182 @@
-from flask import Response, request
+from flask import Response, g, make_response, request
 from functools import wraps
-from helpers import fetchone
-from datetime import datetime
+from helpers import current_data_version
+from notifications import listening, subscribe
+from datetime import date
+import hashlib
+from collections import OrderedDict
+import threading
+import time
+import os
+import logging
 
 
-def last_modified(sql):
-    """Executes sql which returns a value to compare against last_modified_at"""
+def last_modified(validator):
+    """Answers conditional GETs using validator(), which returns a row with
+    the last_modified time and a version string for the data behind the page.
+
+    The ETag is a hash of the version so it changes whenever anything the page
+    shows changes, even when last_modified doesn't (mulligans, green weeks).
+    """
 
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            last_modified = fetchone(sql, []).last_modified
-            if_modified_since = request.headers.get("If-Modified-Since")
-            if if_modified_since and last_modified == datetime.fromisoformat(
-                request.headers.get("If-Modified-Since")
-            ):
-                return Response(status=304)
-
-            response = f(*args, **kwargs)
-            if type(response) is str:
-                response = Response(response)
-            response.headers["Last-Modified"] = last_modified
+            validators = validator()
+            etag = hashlib.sha1(
+                ("%s:%s" % (f.__name__, validators.version)).encode("utf-8")
+            ).hexdigest()
+            modified = validators.last_modified
+            if modified is not None:
+                modified = modified.replace(microsecond=0)
+            g.data_version = validators.version
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains(etag)
+            else:
+                not_modified = (
+                    modified is not None
+                    and request.if_modified_since is not None
+                    and modified <= request.if_modified_since
+                )
+
+            if not_modified:
+                response = Response(status=304)
+            else:
+                response = make_response(f(*args, **kwargs))
+            response.set_etag(etag)
+            if modified is not None:
+                response.last_modified = modified
             return response
 
         return decorated_function
 
     return decorator
+
+
+class RenderCache:
+    """LRU of rendered pages bounded by the total size of the cached bodies.
+
+    Entries are tagged with the challenge they show so change notifications
+    can drop exactly those. Writes made by other processes only reach us
+    through notifications, so entries expire after `ttl` seconds whenever the
+    listener is down and after the much longer `listening_ttl` otherwise.
+    """
+
+    def __init__(self, max_bytes, ttl, listening_ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.listening_ttl = listening_ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            ttl = self.listening_ttl if listening.is_set() else self.ttl
+            if entry is None or entry[0] + ttl < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, body, challenge_id=None):
+        size = len(body.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic(), body, size, challenge_id)
+            self.size += size
+            while self.size > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate_challenge(self, challenge_id):
+        with self._lock:
+            stale = [k for k, e in self._entries.items() if e[3] == challenge_id]
+            for key in stale:
+                self._remove(key)
+            self.invalidations += len(stale)
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "listening": listening.is_set(),
+        }
+
+    def _remove(self, key):
+        _, _, size, _ = self._entries.pop(key)
+        self.size -= size
+
+
+render_cache = RenderCache(
+    max_bytes=int(os.environ.get("RENDER_CACHE_MAX_BYTES", 8 * 1024 * 1024)),
+    ttl=float(os.environ.get("RENDER_CACHE_TTL", 60)),
+    listening_ttl=float(os.environ.get("RENDER_CACHE_LISTENING_TTL", 3600)),
+)
+render_cache_disabled = os.environ.get("RENDER_CACHE_DISABLED") is not None
+
+
+@subscribe
+def invalidate_render_cache(change):
+    # New challenges and challenger changes show up on every challenge's pages
+    if change is None or change.challenge_id is None or change.table == "challenges":
+        render_cache.clear()
+    else:
+        render_cache.invalidate_challenge(change.challenge_id)
+
+
+def cached_render(f):
+    """Caches the rendered page per query string, day and data version.
+
+    When the view also uses last_modified, the validator's version is part of
+    the key so writes made by other processes are picked up straight away.
+    Views set g.challenge_id so the entry can be invalidated with its challenge.
+
+    Pass `nocache` in the query string to bypass the cache.
+    """
+
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if render_cache_disabled or "nocache" in request.args:
+            return f(*args, **kwargs)
+
+        key = (
+            f.__name__,
+            tuple(sorted(request.args.items(multi=True))),
+            date.today(),
+            current_data_version(),
+            g.get("data_version"),
+        )
+        body = render_cache.get(key)
+        if body is None:
+            logging.debug("render cache miss %s", key)
+            body = f(*args, **kwargs)
+            if type(body) is str:
+                render_cache.put(key, body, g.get("challenge_id"))
+        return body
+
+    return decorated_function
@@ -0,0 +1,154 @@
+from helpers import gather, query
+from notifications import listening, subscribe
+from datetime import datetime, timedelta
+from typing import NamedTuple
+import bisect
+import itertools
+import threading
+import time
+import os
+import pytz
+import logging
+
+# How long a calendar is trusted when change notifications aren't available
+CALENDAR_TTL = float(os.environ.get("CALENDAR_TTL", 60))
+
+
+class WeekOption(NamedTuple):
+    name: str
+    id: int
+    start: datetime
+
+
+@query()
+def all_challenges():
+    return 'select * from challenges order by start, "end"', []
+
+
+@query()
+def all_challenge_weeks():
+    return "select * from challenge_weeks order by start, id", []
+
+
+class ChallengeCalendar:
+    """Every challenge and challenge week, indexed for date lookups.
+
+    Instances are never modified; a refresh builds a new one and swaps it in.
+    """
+
+    def __init__(self, challenges, weeks):
+        self.challenges = challenges
+        self.challenges_by_id = {c.id: c for c in challenges}
+        self.challenges_by_name = {c.name: c for c in challenges}
+        self.weeks = weeks
+        self.weeks_by_id = {w.id: w for w in weeks}
+        self.weeks_by_challenge = {
+            challenge_id: list(group)
+            for challenge_id, group in itertools.groupby(
+                sorted(weeks, key=lambda w: (w.challenge_id, w.start, w.id)),
+                key=lambda w: w.challenge_id,
+            )
+        }
+        self._week_starts = [w.start for w in weeks]
+        self._longest_week = max(
+            (w.end - w.start for w in weeks), default=timedelta(0)
+        )
+        self._challenge_starts = [c.start for c in challenges]
+        self._longest_challenge = max(
+            (c.end - c.start for c in challenges), default=timedelta(0)
+        )
+        self.week_options = [
+            [
+                WeekOption(self.challenges_by_id[w.challenge_id].name, w.id, w.start)
+                for w in group
+            ]
+            for _, group in itertools.groupby(
+                weeks, key=lambda w: self.challenges_by_id[w.challenge_id].name
+            )
+        ]
+
+    def week_on(self, day):
+        """The challenge week whose [start, end] contains day, if any"""
+        i = bisect.bisect_right(self._week_starts, day) - 1
+        while i >= 0 and self.weeks[i].start >= day - self._longest_week:
+            if self.weeks[i].end >= day:
+                return self.weeks[i]
+            i -= 1
+        return None
+
+    def challenge_on(self, day):
+        i = bisect.bisect_right(self._challenge_starts, day) - 1
+        while i >= 0 and self.challenges[i].start >= day - self._longest_challenge:
+            if self.challenges[i].end >= day:
+                return self.challenges[i]
+            i -= 1
+        return None
+
+    def week_at(self, instant=None, tz="America/New_York"):
+        """The challenge week containing instant (now if not given) in tz.
+        Naive instants are taken to already be local to tz."""
+        return self.week_on(local_date(instant, tz))
+
+    def challenge_at(self, instant=None, tz="America/New_York"):
+        return self.challenge_on(local_date(instant, tz))
+
+    def weeks_of(self, challenge_id):
+        return self.weeks_by_challenge.get(challenge_id, [])
+
+    def possible_checkins(self, challenge_id):
+        return len(self.weeks_of(challenge_id)) * 5
+
+    def possible_checkins_so_far(self, challenge_id, week_id, today=None):
+        today = today or datetime.now()
+        weeks_before = sum(1 for w in self.weeks_of(challenge_id) if w.id < week_id)
+        return weeks_before * 5 + min(today.weekday() + 1, 5)
+
+
+def local_date(instant, tz):
+    if instant is None:
+        return datetime.now(pytz.timezone(tz)).date()
+    if instant.tzinfo is None:
+        return instant.date()
+    return instant.astimezone(pytz.timezone(tz)).date()
+
+
+_calendar = None
+_loaded_at = 0.0
+_stale = True
+_lock = threading.Lock()
+
+
+def invalidate():
+    global _stale
+    _stale = True
+
+
+@subscribe
+def _on_change(change):
+    if change is None or change.table in ("challenges", "challenge_weeks"):
+        invalidate()
+
+
+def get_calendar():
+    """Returns the cached calendar, reloading it after challenges or weeks
+    change (or after CALENDAR_TTL when we can't hear about changes)."""
+    global _calendar, _loaded_at, _stale
+    expired = (
+        not listening.is_set() and time.monotonic() - _loaded_at > CALENDAR_TTL
+    )
+    if _calendar is None or _stale or expired:
+        with _lock:
+            _stale = False
+            try:
+                challenges, weeks = gather(
+                    all_challenges.query(), all_challenge_weeks.query()
+                )
+            except Exception:
+                _stale = True
+                raise
+            _calendar = ChallengeCalendar(challenges, weeks)
+            _loaded_at = time.monotonic()
+            logging.debug(
+                "loaded calendar: %s challenges %s weeks", len(challenges), len(weeks)
+            )
+    return _calendar
@@ -1,12 +1,10 @@
-import cairosvg
 import svgwrite
 import logging
 import itertools
 from typing import List, Dict, NamedTuple
-from helpers import fetchall, fetchone
 from datetime import datetime, timedelta, date
 import os
-from rule_sets import score
+from rule_sets import get_rule_set
 
 
 weekdays = [
@@ -20,6 +18,22 @@ weekdays = [
 ]
 
 
+colors = ["#f7f7f7", "#cccccc", "#969696", "#636363", "#252525"]
+greens = [
+    "#edf8e9",
+    "#c7e9c0",
+    "#a1d99b",
+    "#74c476",
+    "#41ab5d",
+    "#238b45",
+    "#005a32",
+]
+
+# "template" streams markup straight into a list of strings, "svgwrite" builds
+# it with svgwrite objects. Both produce identical SVG.
+CHART_RENDERER = os.environ.get("CHART_RENDERER", "template")
+
+
 class DataUnit(NamedTuple):
     x: str
     y: int
@@ -35,59 +49,22 @@ class CheckinChartData(NamedTuple):
     totalCheckins: int
     points: float
     hasMulliganed: bool
+    knockedOut: bool
 
     def tostring(self) -> str:
         return json.dumps({"name": self.name, "data": self.data})
 
 
-def knocked_out(challenge_id):
-    return [
-        r.name
-        for r in fetchall(
-            """
-        SELECT name FROM challengers c
-        JOIN challenger_challenges cc ON c.id = cc.challenger_id
-        WHERE cc.challenge_id = %s AND cc.knocked_out = true
-        """,
-            [challenge_id],
-        )
-    ]
-
-
-def get_names(challenge_id):
-    return [
-        r.name
-        for r in fetchall(
-            """
-        SELECT name FROM challengers c
-        JOIN challenger_challenges cc ON c.id = cc.challenger_id
-        WHERE cc.challenge_id = %s
-        """,
-            [challenge_id],
-        )
-    ]
-
-
-def mulliganed_challengers(challenge_id):
-    return [
-        r.name
-        for r in fetchall(
-            """
-        SELECT name FROM challengers c
-        JOIN challenger_challenges cc ON c.id = cc.challenger_id
-        WHERE cc.challenge_id = %s
-        and cc.mulligan is not null
-        """,
-            [challenge_id],
-        )
-    ]
+def checkin_chart(*args, **kwargs):
+    if CHART_RENDERER == "svgwrite":
+        return svgwrite_checkin_chart(*args, **kwargs)
+    return template_checkin_chart(*args, **kwargs)
 
 
-def checkin_chart(
+def svgwrite_checkin_chart(
     data: List[CheckinChartData],
     width: int,
     height: int,
-    challenge_id,
     green,
     bye_week,
     total_points,
@@ -104,16 +81,6 @@ def checkin_chart(
     wGap = 0
     hGap = 20
     gutter = 85
-    colors = ["#f7f7f7", "#cccccc", "#969696", "#636363", "#252525"]
-    greens = [
-        "#edf8e9",
-        "#c7e9c0",
-        "#a1d99b",
-        "#74c476",
-        "#41ab5d",
-        "#238b45",
-        "#005a32",
-    ]
     green_mode = greens[4]
     base_color = green_mode if green else "white"
 
@@ -130,14 +97,12 @@ def checkin_chart(
             fill="white" if not green else green_mode,
         )
     )
-    knocked_out_names = knocked_out(challenge_id)
-    logging.info("knocked out: %s", knocked_out_names)
     logging.info("Achievements: %s", achievements)
     text_color = "black" if green else ""
     for column, chart in enumerate(data):
         yLabel = chart.name
         hasMulliganed = chart.hasMulliganed
-        is_knocked_out = yLabel in knocked_out_names
+        is_knocked_out = chart.knockedOut
         a = svgwrite.container.Hyperlink("/challenger/%s" % chart.name, target="_self")
         mulligan_circle = dwg.circle(
             center=(5, rectH * column + hGap * column + gutter + rectH / 4),
@@ -370,108 +335,327 @@ def write_points(dwg, chart, total_points, x, y):
         dwg.add(text)
 
 
-def write_og_image(svg, week):
-    try:
-        output = "./static/preview-{week}.png".format(week=week)
-        cairosvg.svg2png(bytestring=svg.encode("utf-8"), write_to=output)
-    except:
-        logging.error("Failed to write og image")
+SVG_HEADER = (
+    '<svg baseProfile="full" height="{height}" version="1.1" width="{width}"'
+    ' xmlns="http://www.w3.org/2000/svg"'
+    ' xmlns:ev="http://www.w3.org/2001/xml-events"'
+    ' xmlns:xlink="http://www.w3.org/1999/xlink"><defs />'
+)
 
 
-def sortCheckinByWeekday(data: List[str]) -> List[str]:
-    return sorted(data, key=lambda x: weekdays.index(x.day_of_week))
+def escape_text(value):
+    return value.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
 
 
-def week_heat_map_from_checkins(checkins, challenge_id, rule_set):
-    heatmap_data = []
-    latest_date = None
-    latest_date = fetchone(
-        "select time at time zone 'America/New_York' from checkins order by time desc limit 1"
+def escape_attribute(value):
+    return (
+        escape_text(value)
+        .replace('"', "&quot;")
+        .replace("\r", "&#13;")
+        .replace("\n", "&#10;")
+        .replace("\t", "&#09;")
+    )
+
+
+def attribute(name, value):
+    """Optional attribute; like svgwrite, empty values are left out"""
+    return ' %s="%s"' % (name, escape_attribute(value)) if value else ""
+
+
+def svg_text(content, transform, fill=""):
+    """<text> as svgwrite serializes dwg.text(content, fill=fill).translate(...)"""
+    attrs = '%s transform="translate(%s,%s)"' % (
+        attribute("fill", fill),
+        transform[0],
+        transform[1],
+    )
+    if content:
+        return "<text%s>%s</text>" % (attrs, escape_text(content))
+    return "<text%s />" % attrs
+
+
+def svg_rect(x, y, w, h, fill, stroke):
+    return (
+        '<rect fill="%s" height="%s" rx="2" ry="2" stroke="%s" stroke-width="1"'
+        ' width="%s" x="%s" y="%s" />' % (fill, h, stroke, w, x, y)
+    )
+
+
+def template_checkin_chart(
+    data: List[CheckinChartData],
+    width: int,
+    height: int,
+    green,
+    bye_week,
+    total_points,
+    achievements,
+    total_checkins,
+    total_possible_checkins,
+    total_possible_checkins_so_far,
+):
+    """Renders the same markup as svgwrite_checkin_chart, but formats every
+    element straight into a list of strings instead of building svgwrite
+    objects and serializing them through ElementTree."""
+    if len(data) == 0:
+        logging.warning("empty week + year selected")
+        return SVG_HEADER.format(height=10, width=10) + "</svg>"
+
+    wGap = 0
+    hGap = 20
+    gutter = 85
+    green_mode = greens[4]
+    base_color = green_mode if green else "white"
+
+    columns = len(data)
+    rows = len(data[0].data)
+    rectW = (width - rows * wGap - gutter) / (rows + 3)
+    rectH = (height - columns * hGap - gutter) / (columns)
+
+    out = [SVG_HEADER.format(height=height, width=width + 1)]
+    out.append(
+        '<rect fill="%s" height="100%%" width="100%%" x="0" y="0" />'
+        % ("white" if not green else green_mode)
     )
-    checkins.sort(key=lambda x: x.name)
-    weeks_grouped_by_name = {
-        name: list(value)
-        for name, value in itertools.groupby(checkins, key=lambda x: x.name)
-    }
-
-    names = get_names(challenge_id)
-    mulliganed = mulliganed_challengers(challenge_id)
-    logging.info("Challengers: %s", names)
-    logging.info("Mulliganed Challengers: %s", mulliganed)
-    for name in names:
-        if name not in weeks_grouped_by_name:
-            weeks_grouped_by_name[name] = []
+    logging.info("Achievements: %s", achievements)
+    text_color = "black" if green else ""
+    earliest, latest, first_to_five, highest_tier = achievements
+    for column, chart in enumerate(data):
+        yLabel = chart.name
+        hasMulliganed = chart.hasMulliganed
+        is_knocked_out = chart.knockedOut
+        top = column * rectH + column * hGap + gutter
+        out.append(
+            '<circle cx="5" cy="%s" fill="%s" r="5" stroke="%s" />'
+            % (
+                rectH * column + hGap * column + gutter + rectH / 4,
+                "transparent" if hasMulliganed else greens[5],
+                greens[5],
+            )
+        )
+        label = '<text fill="currentcolor" font-size="14"%s x="15" y="%s"' % (
+            attribute("text-decoration", "line-through" if is_knocked_out else ""),
+            rectH * column + hGap * column + gutter + rectH / 2,
+        )
+        label += (">%s</text>" % escape_text(yLabel)) if yLabel else " />"
+        out.append(
+            '<a target="_self" xlink:href="%s">%s</a>'
+            % (escape_attribute("/challenger/%s" % chart.name), label)
+        )
+        text_y = column * rectH + column * hGap + gutter + rectH / 2 + 5
+        for row, dataUnit in enumerate(chart.data):
+            x = dataUnit.x
+            checkedIn = dataUnit.checkedIn
+            isMulligan = dataUnit.isMulligan
+            fill_color = colors[2] if checkedIn and not is_knocked_out else base_color
+            fill_color = colors[0] if is_knocked_out and checkedIn else fill_color
+            stroke_color = colors[3] if not is_knocked_out else colors[1]
 
+            if chart.totalCheckins >= 5 and dataUnit.y != 0:
+                fill_color = greens[4] if not green else greens[6]
+            if chart.totalCheckins >= 5:
+                stroke_color = greens[6]
+            # gold for 7!
+            if chart.totalCheckins >= 7:
+                fill_color = "#D4AF37"
+            # lime for first to five
+            if (
+                first_to_five is not None
+                and chart.totalCheckins >= 5
+                and chart.name == first_to_five[0]
+                and dataUnit.time == first_to_five[1]
+            ):
+                fill_color = "#39FF14"
+            # Mulligans are always grey
+            if isMulligan:
+                fill_color = colors[2]
+
+            if column == 0:
+                # add day of week
+                out.append(
+                    svg_text(
+                        x[:3],
+                        (rectW * row + wGap * row + gutter + rectW / 2 - 10, gutter - 10),
+                        text_color,
+                    )
+                )
+
+            left = row * rectW + row * wGap + gutter
+            out.append("<g>")
+            out.append(svg_rect(left, top, rectW, rectH, fill_color, stroke_color))
+            if dataUnit.tier:
+                out.append(svg_text(dataUnit.tier, (left + rectW / 2 - 5, text_y)))
+            time_hour = (
+                dataUnit.time.strftime("%H:%M") if dataUnit.time is not None else None
+            )
+            if time_hour is not None and time_hour == latest:
+                out.append(svg_text("🌚", (left + rectW / 2 + 15, text_y)))
+            if time_hour is not None and time_hour == earliest:
+                out.append(svg_text("🌞", (left + rectW / 2 + 15, text_y)))
+            if time_hour is not None and time_hour == highest_tier[1]:
+                out.append(svg_text(" 🥇", (left + rectW / 2 + 25, text_y)))
+            if dataUnit.isMulligan:
+                out.append(svg_text("(M)", (left + rectW / 2 + 15, text_y)))
+            out.append("</g>")
+
+        if chart.name in total_points:
+            out.append(
+                svg_text(
+                    "%.1f (%.1f)" % (round(chart.points, 1), total_points[chart.name]),
+                    (
+                        rows * rectW + rows * wGap + gutter + rectW / 2 - 30,
+                        column * rectH + column * hGap + gutter + rectH / 2,
+                    ),
+                )
+            )
+        if column == 0:
+            # add checkins heading
+            out.append(
+                svg_text(
+                    "Checkins",
+                    (
+                        rectW * (rows + 1.1) + wGap * (rows + 1.1) + gutter + rectW / 2 - 10,
+                        gutter - 10,
+                    ),
+                    text_color,
+                )
+            )
+        if chart.name in total_checkins:
+            bar_left = (rows + 1.5) * rectW + (rows + 1.5) * wGap + gutter
+            percent_checked_in = float(
+                total_checkins[chart.name] / total_possible_checkins
+            )
+            out.append("<g>")
+            out.append(svg_rect(bar_left, top, rectW, rectH, "none", stroke_color))
+            out.append(
+                svg_rect(
+                    bar_left,
+                    top,
+                    rectW * percent_checked_in,
+                    rectH,
+                    greens[5],
+                    stroke_color,
+                )
+            )
+            if total_possible_checkins != total_possible_checkins_so_far:
+                percent_complete = (
+                    total_possible_checkins_so_far / total_possible_checkins
+                )
+                x = (
+                    (rows + 1.5) * rectW
+                    + (rows + 1.5) * wGap
+                    + gutter
+                    + (rectW * percent_complete)
+                )
+                out.append(
+                    '<line stroke="black" stroke-width="2" x1="%s" x2="%s" y1="%s" y2="%s" />'
+                    % (x, x, top, top + rectH)
+                )
+            out.append("</g>")
+
+    # Add Points Label
+    out.append(
+        svg_text(
+            "Points",
+            (rectW * (rows) + wGap * (rows) + gutter + rectW / 2 - 30, gutter - 30),
+            text_color,
+        )
+    )
+    out.append(
+        svg_text(
+            "(Total)",
+            (rectW * (rows) + wGap * (rows) + gutter + rectW / 2 - 30, gutter - 10),
+            text_color,
+        )
+    )
+
+    if bye_week:
+        out.append(
+            '<text font-size="200" transform="translate(%s,%s)">BYE</text>'
+            % (width / 4, height / 2)
+        )
+        out.append(
+            '<text font-size="200" transform="translate(%s,%s)">WEEK</text>'
+            % (width / 4 - 50, height / 2 + 175)
+        )
+
+    out.append("</svg>")
+    return "".join(out)
+
+
+weekday_index = {weekday: i for i, weekday in enumerate(weekdays)}
+
+
+def sortCheckinByWeekday(data: List[str]) -> List[str]:
+    return sorted(data, key=lambda x: weekday_index[x.day_of_week])
+
+
+def week_heat_map_from_checkins(view, rule_set):
+    """Builds the heat map rows for a week plus its achievements: the earliest
+    and latest checkin times, who was first to five checkins and the time of
+    the highest tier checkin.
+
+    Each participant's checkins are indexed by weekday once, so filling in the
+    seven days is a dict lookup rather than a scan.
+    """
+    heatmap_data = []
     latest = "00:00"
     earliest = "23:59"
     first_to_five = None
     highest_tier = (1, "")
-    if len(checkins) > 0:
-        last_checkin = sorted(checkins, key=lambda x: x.time, reverse=True)[0]
-        first_to_five = (last_checkin.name, last_checkin.time)
-    for name in weeks_grouped_by_name:
-        sorted_checkins = sortCheckinByWeekday(weeks_grouped_by_name[name])
-        logging.info("checkins %s" % sorted_checkins)
+    rule_set = get_rule_set(rule_set)
+
+    last_checkin = None
+    for participant in view.participants:
+        for checkin in participant.checkins:
+            if last_checkin is None or checkin.time > last_checkin[1]:
+                last_checkin = (participant.name, checkin.time)
+    if last_checkin is not None:
+        first_to_five = last_checkin
+
+    for participant in view.participants:
+        name = participant.name
+        # (y, checkin, "HH:MM") per weekday; y is the 1-based position of the
+        # day among the participant's checkins in weekday order
+        by_weekday = {}
+        for index, checkin in enumerate(sortCheckinByWeekday(participant.checkins)):
+            if checkin.day_of_week not in by_weekday:
+                by_weekday[checkin.day_of_week] = (
+                    index + 1,
+                    checkin,
+                    checkin.time.strftime("%H:%M"),
+                )
         data = []
         total_checkins = 0
         point_checkins = []
-        for i, weekday in enumerate(weekdays):
-            checkinIndex = next(
-                (
-                    index
-                    for index, checkin in enumerate(sorted_checkins)
-                    if checkin.day_of_week == weekday
-                ),
-                -1,
-            )
-            tier = (
-                sorted_checkins[checkinIndex].tier
-                if len(sorted_checkins) > checkinIndex and checkinIndex >= 0
-                else None
-            )
-            time = (
-                sorted_checkins[checkinIndex].time
-                if len(sorted_checkins) > checkinIndex and checkinIndex >= 0
-                else None
-            )
-            isMulligan = (
-                sorted_checkins[checkinIndex].ismulligan
-                if len(sorted_checkins) > checkinIndex and checkinIndex >= 0
-                else None
-            )
-            time_hour = time.strftime("%H:%M") if time else None
-            checked_in = bool(checkinIndex + 1)
-            if time_hour and time_hour > latest:
+        for weekday in weekdays:
+            found = by_weekday.get(weekday)
+            if found is None:
+                data.append(DataUnit(weekday, 0, False, None, None, None))
+                continue
+            y, checkin, time_hour = found
+            time = checkin.time
+            tier = checkin.tier
+            if time_hour > latest:
                 latest = time_hour
-            if time_hour and time_hour < earliest:
-                logging.info(
-                    "time hour %s earliest %s checkin %s", time_hour, earliest, name
-                )
+            if time_hour < earliest:
                 earliest = time_hour
-            total_checkins += 1 if checked_in else 0
-            if (
-                first_to_five is not None
-                and total_checkins > 4
-                and time is not None
-                and time < first_to_five[1]
-            ):
-                logging.debug("new first to five %s %s", name, time)
+            total_checkins += 1
+            if total_checkins > 4 and time < first_to_five[1]:
                 first_to_five = (name, time)
-            if tier and not sorted_checkins[checkinIndex].bye_week:
-                points = score(tier, rule_set)
+            if tier and not view.bye_week:
+                points = rule_set.score(tier)
                 point_checkins.append(points)
                 if points > highest_tier[0]:
-                    highest_tier = (points, time.strftime("%H:%M"))
-            data.append(
-                DataUnit(weekday, checkinIndex + 1, checked_in, time, tier, isMulligan)
-            )
+                    highest_tier = (points, time_hour)
+            data.append(DataUnit(weekday, y, True, time, tier, checkin.ismulligan))
         heatmap_data.append(
             CheckinChartData(
                 name,
                 data,
                 total_checkins,
                 sum(sorted(point_checkins, reverse=True)[:5]),
-                name in mulliganed,
+                participant.hasMulliganed,
+                participant.knockedOut,
             )
         )
-    return heatmap_data, latest_date[0], (earliest, latest, first_to_five, highest_tier)
+    return heatmap_data, view.latest, (earliest, latest, first_to_five, highest_tier)
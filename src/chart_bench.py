@@ -0,0 +1,212 @@
+from base_queries import DayCheckin, Participant, WeekView
+from chart import (
+    CheckinChartData,
+    DataUnit,
+    sortCheckinByWeekday,
+    svgwrite_checkin_chart,
+    template_checkin_chart,
+    week_heat_map_from_checkins,
+    weekdays,
+)
+from rule_sets import score
+from datetime import datetime, timedelta
+from decimal import Decimal
+import contextlib
+import io
+import random
+import time
+import logging
+
+
+def legacy_week_heat_map_from_checkins(view, rule_set):
+    """How the week heat map was built before, scanning each participant's
+    checkins for every weekday, to benchmark against"""
+    heatmap_data = []
+    checkins = [
+        (participant.name, checkin)
+        for participant in view.participants
+        for checkin in participant.checkins
+    ]
+    logging.info("Challengers: %s", [p.name for p in view.participants])
+
+    latest = "00:00"
+    earliest = "23:59"
+    first_to_five = None
+    highest_tier = (1, "")
+    if len(checkins) > 0:
+        name, last_checkin = max(checkins, key=lambda x: x[1].time)
+        first_to_five = (name, last_checkin.time)
+    for participant in view.participants:
+        name = participant.name
+        sorted_checkins = sortCheckinByWeekday(participant.checkins)
+        logging.info("checkins %s" % sorted_checkins)
+        data = []
+        total_checkins = 0
+        point_checkins = []
+        for i, weekday in enumerate(weekdays):
+            checkinIndex = next(
+                (
+                    index
+                    for index, checkin in enumerate(sorted_checkins)
+                    if checkin.day_of_week == weekday
+                ),
+                -1,
+            )
+            tier = (
+                sorted_checkins[checkinIndex].tier
+                if len(sorted_checkins) > checkinIndex and checkinIndex >= 0
+                else None
+            )
+            time = (
+                sorted_checkins[checkinIndex].time
+                if len(sorted_checkins) > checkinIndex and checkinIndex >= 0
+                else None
+            )
+            isMulligan = (
+                sorted_checkins[checkinIndex].ismulligan
+                if len(sorted_checkins) > checkinIndex and checkinIndex >= 0
+                else None
+            )
+            time_hour = time.strftime("%H:%M") if time else None
+            checked_in = bool(checkinIndex + 1)
+            if time_hour and time_hour > latest:
+                latest = time_hour
+            if time_hour and time_hour < earliest:
+                logging.info(
+                    "time hour %s earliest %s checkin %s", time_hour, earliest, name
+                )
+                earliest = time_hour
+            total_checkins += 1 if checked_in else 0
+            if (
+                first_to_five is not None
+                and total_checkins > 4
+                and time is not None
+                and time < first_to_five[1]
+            ):
+                logging.debug("new first to five %s %s", name, time)
+                first_to_five = (name, time)
+            if tier and not view.bye_week:
+                points = score(tier, rule_set)
+                point_checkins.append(points)
+                if points > highest_tier[0]:
+                    highest_tier = (points, time.strftime("%H:%M"))
+            data.append(
+                DataUnit(weekday, checkinIndex + 1, checked_in, time, tier, isMulligan)
+            )
+        heatmap_data.append(
+            CheckinChartData(
+                name,
+                data,
+                total_checkins,
+                sum(sorted(point_checkins, reverse=True)[:5]),
+                participant.hasMulliganed,
+                participant.knockedOut,
+            )
+        )
+    return heatmap_data, view.latest, (earliest, latest, first_to_five, highest_tier)
+
+
+def sample_week(challengers, bye_week=False, seed=0):
+    """A synthetic week view: each challenger checks in on about 60% of days"""
+    rng = random.Random(seed)
+    monday = datetime(2024, 3, 4)
+    participants = []
+    for n in range(challengers):
+        checkins = [
+            DayCheckin(
+                weekday,
+                "T%s" % rng.randint(0, 6),
+                monday
+                + timedelta(days=day, hours=rng.randint(4, 22), minutes=rng.randint(0, 59)),
+                rng.random() < 0.02,
+            )
+            for day, weekday in enumerate(weekdays)
+            if rng.random() < 0.6
+        ]
+        checkins.sort(key=lambda checkin: checkin.time, reverse=True)
+        participants.append(
+            Participant("c%04d" % n, rng.random() < 0.1, rng.random() < 0.05, checkins)
+        )
+    return WeekView(1, 1, False, bye_week, monday, participants)
+
+
+def sample_chart(challengers, seed=0, green=False, bye_week=False):
+    """checkin_chart's arguments for a synthetic week, with names that need
+    escaping and challengers missing from the totals"""
+    rng = random.Random(seed)
+    view = sample_week(challengers, bye_week, seed)
+    view = view._replace(
+        participants=[
+            participant._replace(
+                name=participant.name + rng.choice(["", " & co", "<b>", '"q"', "é🌚"])
+            )
+            for participant in view.participants
+        ]
+    )
+    week, _, achievements = week_heat_map_from_checkins(view, 2)
+    names = [participant.name for participant in view.participants]
+    total_points = {name: rng.random() * 30 for name in names if rng.random() < 0.8}
+    total_checkins = {
+        name: Decimal(rng.randint(0, 60)) for name in names if rng.random() < 0.8
+    }
+    return (
+        week,
+        1000,
+        600,
+        green,
+        bye_week,
+        total_points,
+        achievements,
+        total_checkins,
+        60,
+        rng.choice([20, 60]),
+    )
+
+
+if __name__ == "__main__":
+    # python chart_bench.py checks week_heat_map_from_checkins against the
+    # implementation it replaced on synthetic weeks of 10, 100 and 1000
+    # challengers and times both, then does the same for the two chart
+    # renderers, which must produce identical markup
+    logging.disable(logging.CRITICAL)
+    print("%-18s %12s %12s" % ("heat map", "before", "after"))
+    for challengers in [10, 100, 1000]:
+        view = sample_week(challengers)
+        for rule_set in [1, 2]:
+            for checked in [view, sample_week(challengers, bye_week=True)]:
+                assert week_heat_map_from_checkins(
+                    checked, rule_set
+                ) == legacy_week_heat_map_from_checkins(checked, rule_set), (
+                    challengers,
+                    rule_set,
+                )
+        runs = max(3, 3000 // challengers)
+        timings = []
+        for build in [legacy_week_heat_map_from_checkins, week_heat_map_from_checkins]:
+            start = time.perf_counter()
+            for _ in range(runs):
+                build(view, 2)
+            timings.append((time.perf_counter() - start) / runs * 1000)
+        print("%-18s %10.2fms %10.2fms" % ("%s challengers" % challengers, *timings))
+
+    # svgwrite_checkin_chart prints every mulligan
+    quiet = contextlib.redirect_stdout(io.StringIO())
+    for seed in range(200):
+        args = sample_chart(
+            random.Random(seed).randint(0, 12), seed, seed % 3 == 0, seed % 5 == 0
+        )
+        with quiet:
+            expected = svgwrite_checkin_chart(*args)
+        assert template_checkin_chart(*args) == expected, seed
+    print("%-18s %12s %12s" % ("chart per row", "svgwrite", "template"))
+    for challengers in [10, 100, 1000]:
+        args = sample_chart(challengers, seed=1)
+        runs = max(2, 500 // challengers)
+        timings = []
+        for render in [svgwrite_checkin_chart, template_checkin_chart]:
+            start = time.perf_counter()
+            with quiet:
+                for _ in range(runs):
+                    render(*args)
+            timings.append((time.perf_counter() - start) / runs / challengers * 1000)
+        print("%-18s %10.3fms %10.3fms" % ("%s challengers" % challengers, *timings))
@@ -0,0 +1,141 @@
+from pathlib import Path
+from typing import Iterable, List, NamedTuple, Optional
+import json
+import re
+import sys
+import time
+
+# Only a message's first line counts, as `.` never matched a newline in the
+# patterns this replaced
+CHECKIN = re.compile(r"check.?in|✅")
+TIER = re.compile(r"t[0-9]+")
+# Tapbacks and other reactions quoting someone else's checkin, anywhere in
+# the message
+REACTIONS = ("liked", "emphasized", "loved", "laughed", 'to "', "to “")
+
+CORPUS = Path(__file__).parent / "classify_corpus.jsonl"
+
+
+class Classification(NamedTuple):
+    is_checkin: bool
+    # "T3", or None when the first line doesn't name a tier
+    tier: Optional[str]
+    # "checkin", "unknown tier", "not checkin" or "reaction"
+    reason: str
+
+
+def classify(message):
+    """Whether message is a checkin, the tier it names and why, lowercasing
+    it once and only reading past the first line to look for reactions"""
+    body = message.lower()
+    end = body.find("\n")
+    first = body if end < 0 else body[:end]
+    tier = None
+    for match in TIER.finditer(first):
+        tier = match
+    if tier is not None:
+        tier = tier.group().upper()
+    if CHECKIN.search(first) is None:
+        return Classification(False, tier, "not checkin")
+    for reaction in REACTIONS:
+        if reaction in body:
+            return Classification(False, tier, "reaction")
+    return Classification(True, tier, "checkin" if tier else "unknown tier")
+
+
+def classify_many(messages: Iterable[str]) -> List[Classification]:
+    """classify for each message, classifying repeated messages once"""
+    seen = {}
+    results = []
+    for message in messages:
+        result = seen.get(message)
+        if result is None:
+            result = seen[message] = classify(message)
+        results.append(result)
+    return results
+
+
+def is_checkin(message):
+    return classify(message).is_checkin
+
+
+def get_tier(message):
+    return classify(message).tier or "unknown"
+
+
+def corpus():
+    """(message, expected Classification, note) for each labeled message"""
+    with open(CORPUS) as f:
+        for line in f:
+            row = json.loads(line)
+            yield row["message"], Classification(
+                row["is_checkin"], row["tier"], row["reason"]
+            ), row["note"]
+
+
+def legacy_is_checkin(message):
+    """The regexes classify replaced, to benchmark against"""
+    body = message.lower()
+    matches = (
+        re.match(".*((t\\d+)?.?(check.?in.?|✅)|(check.?in.?|✅)(t\\d+)?).*", body)
+        is not None
+    )
+    return (
+        matches
+        and "liked" not in body
+        and "emphasized" not in body
+        and "loved" not in body
+        and "laughed" not in body
+        and 'to "' not in body
+        and "to “" not in body
+    )
+
+
+def legacy_get_tier(message):
+    match = re.match(".*(t\\d+).*", message.lower())
+    if match is not None:
+        return match.group(1).upper()
+    return "unknown"
+
+
+if __name__ == "__main__":
+    # python classify.py checks every labeled message in classify_corpus.jsonl
+    # and times classify against the regexes it replaced. Exits 1 on a wrong
+    # label or if classify is more than 10% slower on any kind of message.
+    labeled = list(corpus())
+    wrong = [
+        (message, expected, got, note)
+        for message, expected, note in labeled
+        for got in [classify(message)]
+        if got != expected
+    ]
+    for message, expected, got, note in wrong:
+        print("%s: %r\n  expected %s\n  got      %s" % (note, message[:60], expected, got))
+    print("%s/%s labeled messages right" % (len(labeled) - len(wrong), len(labeled)))
+
+    messages = [message for message, _, _ in labeled]
+    short = [message for message in messages if len(message) < 200]
+    thread = max(messages, key=len)
+    kinds = {
+        "sms": (short, 2000),
+        "forwarded email (%sKB)" % (len(thread) * 40 // 1024): ([thread * 40], 20),
+        "one long line (200KB)": (["checkin t3 " + "x" * 200000], 20),
+        "stored checkins": ([short[n % 12] for n in range(10000)], 10),
+    }
+    def legacy(batch):
+        return [(legacy_is_checkin(m), legacy_get_tier(m)) for m in batch]
+
+    slower = []
+    print("%-28s %12s %12s" % ("", "classify", "regexes"))
+    for kind, (batch, runs) in kinds.items():
+        timings = []
+        for fn in [classify_many, legacy]:
+            start = time.perf_counter()
+            for _ in range(runs):
+                fn(batch)
+            timings.append((time.perf_counter() - start) / runs / len(batch) * 1e6)
+        print("%-28s %10.2fus %10.2fus" % (kind, *timings))
+        if timings[0] > timings[1] * 1.1:
+            slower.append(kind)
+    if wrong or slower:
+        sys.exit(1)
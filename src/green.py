@@ -1,5 +1,7 @@
 from base_queries import get_current_challenge_week
 from helpers import fetchone, with_psycopg
+from notifications import notify_change
+from challenge_calendar import invalidate as invalidate_calendar
 import logging
 import random
 
@@ -31,7 +33,14 @@ def determine_if_green():
             "update challenge_weeks set green = %s where id = %s",
             [green, challenge_week.id],
         )
+        notify_change(
+            cur,
+            "challenge_weeks",
+            challenge_id=challenge_week.challenge_id,
+            challenge_week_id=challenge_week.id,
+        )
 
     if challenge_week.green is None:
         with_psycopg(set_green)
+        invalidate_calendar()
     return green
@@ -1,35 +1,154 @@
-import psycopg
 from psycopg.rows import namedtuple_row
+from psycopg_pool import ConnectionPool
+from flask import g, has_app_context
+from contextlib import contextmanager
+from functools import wraps
+from typing import Any, Callable, NamedTuple, Optional
+import atexit
 import os
 import logging
 
 connection_string = os.environ["DB_CONNECT_STRING"]
 
+# One pool per process. Gunicorn imports the app inside each worker so every
+# worker ends up with its own pool; the pool is only opened on first use so a
+# process that forks after import never shares sockets with its parent.
+pool = ConnectionPool(
+    conninfo=connection_string,
+    kwargs={"row_factory": namedtuple_row},
+    min_size=int(os.environ.get("DB_POOL_MIN_SIZE", 1)),
+    max_size=int(os.environ.get("DB_POOL_MAX_SIZE", 4)),
+    max_idle=float(os.environ.get("DB_POOL_MAX_IDLE", 300)),
+    timeout=float(os.environ.get("DB_POOL_TIMEOUT", 10)),
+    check=ConnectionPool.check_connection,
+    open=False,
+)
+
+
+def get_pool():
+    if pool.closed:
+        pool.open()
+        atexit.register(close_pool)
+    return pool
+
+
+def close_pool():
+    if not pool.closed:
+        logging.info("closing connection pool")
+        pool.close()
+
+
+def get_session():
+    """Returns the connection reads share for the rest of the current request"""
+    if "db" not in g:
+        conn = get_pool().getconn()
+        conn.autocommit = True
+        g.db = conn
+    return g.db
+
+
+def close_session(exception=None):
+    conn = g.pop("db", None)
+    if conn is not None:
+        if not conn.closed:
+            conn.autocommit = False
+        get_pool().putconn(conn)
+
+
+@contextmanager
+def connection():
+    if has_app_context():
+        yield get_session()
+    else:
+        with get_pool().connection() as conn:
+            yield conn
+
+
+class Query(NamedTuple):
+    sql: str
+    args: Any
+    one: bool
+    post: Optional[Callable]
+
+    def result(self, cur):
+        rows = cur.fetchone() if self.one else cur.fetchall()
+        return self.post(rows) if self.post else rows
+
+
+def query(one=False, post=None):
+    """Turns a function returning (sql, args) into one that runs the query.
+
+    The undecorated query is still available as `fn.query(...)` so several of
+    them can be handed to `gather` and sent to postgres together.
+    """
+
+    def decorator(f):
+        def build(*args, **kwargs):
+            sql, params = f(*args, **kwargs)
+            return Query(sql, params, one, post)
+
+        @wraps(f)
+        def run(*args, **kwargs):
+            q = build(*args, **kwargs)
+            with connection() as conn:
+                with conn.cursor() as cur:
+                    logging.info("%s %s", q.sql, q.args)
+                    cur.execute(q.sql, q.args)
+                    return q.result(cur)
+
+        run.query = build
+        return run
+
+    return decorator
+
+
+def gather(*queries):
+    """Runs independent queries in a single pipeline, returning their results in order"""
+    with connection() as conn:
+        with conn.pipeline():
+            cursors = []
+            for q in queries:
+                logging.info("%s %s", q.sql, q.args)
+                cur = conn.cursor()
+                cur.execute(q.sql, q.args)
+                cursors.append(cur)
+            results = [q.result(cur) for q, cur in zip(queries, cursors)]
+        for cur in cursors:
+            cur.close()
+        return results
+
 
 def fetchall(query, args=[]):
-    with psycopg.connect(
-        conninfo=connection_string, row_factory=namedtuple_row
-    ) as conn:
+    with connection() as conn:
         with conn.cursor() as cur:
-            logging.info(query % args)
+            logging.info("%s %s", query, args)
             cur.execute(query, args)
             return cur.fetchall()
 
 
 def fetchone(query, args=[]):
-    with psycopg.connect(
-        conninfo=connection_string, row_factory=namedtuple_row
-    ) as conn:
+    with connection() as conn:
         with conn.cursor() as cur:
-            logging.info(query % args)
+            logging.info("%s %s", query, args)
             cur.execute(query, args)
             result = cur.fetchone()
             return result
 
 
+data_version = 0
+
+
+def current_data_version():
+    return data_version
+
+
 def with_psycopg(fn):
-    with psycopg.connect(
-        conninfo=connection_string, row_factory=namedtuple_row
-    ) as conn:
+    """Runs fn(conn, cur) in its own transaction. Every write goes through
+    here, so it also bumps the data version that rendered pages are cached
+    against once the transaction has committed."""
+    global data_version
+    with get_pool().connection() as conn:
         with conn.cursor() as cur:
-            return fn(conn, cur)
+            result = fn(conn, cur)
+    data_version += 1
+    return result
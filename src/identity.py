@@ -0,0 +1,123 @@
+from helpers import fetchone
+from notifications import listening, subscribe
+from collections import OrderedDict
+from datetime import tzinfo
+from typing import NamedTuple
+import threading
+import time
+import os
+import re
+import pytz
+import logging
+
+# How long a sender is trusted to be who they were, when change notifications
+# keep us up to date and when they can't
+IDENTITY_TTL = float(os.environ.get("IDENTITY_TTL", 3600))
+IDENTITY_UNLISTENED_TTL = float(os.environ.get("IDENTITY_UNLISTENED_TTL", 60))
+# How long an unknown sender stays unknown. Adding a challenger doesn't
+# notify, so keep this short.
+IDENTITY_UNKNOWN_TTL = float(os.environ.get("IDENTITY_UNKNOWN_TTL", 300))
+# Senders remembered at once, so a flood of spam numbers can't grow it forever
+IDENTITY_MAX_SENDERS = int(os.environ.get("IDENTITY_MAX_SENDERS", 10000))
+
+
+class Identity(NamedTuple):
+    id: int
+    name: str
+    tz: str
+    zone: tzinfo
+
+
+# sender key -> (expires at, Identity or None for unknown senders)
+_senders = OrderedDict()
+# bumped by invalidate, so a lookup that raced it doesn't cache what it read
+_generation = 0
+_lock = threading.Lock()
+
+
+def normalize_phone(number):
+    """number in E.164, taking ten digit numbers to be North American"""
+    digits = re.sub(r"\D", "", number)
+    if len(digits) == 10:
+        digits = "1" + digits
+    return "+" + digits
+
+
+def normalize_email(address):
+    number, domain = address.strip().rsplit("@", 1)
+    return "%s@%s" % (number, domain.lower())
+
+
+def _lookup(key, load):
+    now = time.monotonic()
+    with _lock:
+        cached = _senders.get(key)
+        if cached is not None and cached[0] > now:
+            _senders.move_to_end(key)
+            return cached[1]
+        generation = _generation
+    row = load()
+    identity = None
+    if row is not None:
+        identity = Identity(row.id, row.name, row.tz, pytz.timezone(row.tz))
+        ttl = IDENTITY_TTL if listening.is_set() else IDENTITY_UNLISTENED_TTL
+    else:
+        logging.info("unknown sender %s", key)
+        ttl = IDENTITY_UNKNOWN_TTL
+    with _lock:
+        if generation != _generation:
+            return identity
+        _senders[key] = (now + ttl, identity)
+        _senders.move_to_end(key)
+        while len(_senders) > IDENTITY_MAX_SENDERS:
+            _senders.popitem(last=False)
+    return identity
+
+
+def challenger_for_phone(number):
+    """The challenger texting from number, or None"""
+    key = normalize_phone(number)
+    # stored with or without the +1
+    numbers = [key, key[2:]] if key.startswith("+1") else [key]
+    return _lookup(
+        key,
+        lambda: fetchone(
+            "select id, name, tz from challengers where phone_number = any(%s) limit 1",
+            (numbers,),
+        ),
+    )
+
+
+def challenger_for_email(address):
+    """The challenger emailing from address (their number at their carrier's
+    email gateway), or None"""
+    key = normalize_email(address)
+    number, domain = key.split("@")
+    return _lookup(
+        key,
+        lambda: fetchone(
+            "select id, name, tz from challengers "
+            "where phone_number = %s and lower(email_domain) = %s limit 1",
+            (number, domain),
+        ),
+    )
+
+
+def invalidate(challenger_id=None):
+    """Forgets challenger_id, or everyone, along with every unknown sender
+    in case they're now known"""
+    global _generation
+    with _lock:
+        _generation += 1
+        for key, (_, identity) in list(_senders.items()):
+            if challenger_id is None or identity is None or identity.id == challenger_id:
+                del _senders[key]
+
+
+@subscribe
+def _on_change(change):
+    if change is None:
+        invalidate()
+    elif change.table == "challengers":
+        invalidate(change.challenger_id)
+
@@ -0,0 +1,272 @@
+from challenge_calendar import get_calendar
+from classify import classify
+from helpers import fetchall, with_psycopg
+from identity import Identity
+from notifications import notify_change
+from scores import rebuild_scores
+from datetime import datetime
+from typing import NamedTuple
+import argparse
+import csv
+import json
+import re
+import sys
+import time
+import pytz
+import logging
+
+# Formats times are read in besides ISO 8601, starting with the old Google
+# Sheet's. Times without an offset are taken to be the challenger's local time.
+TIME_FORMATS = ("%m/%d/%Y %H:%M:%S", "%m/%d/%Y %H:%M", "%Y-%m-%d %H:%M")
+TIER = re.compile(r"T[0-9]+")
+DAYS = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+
+# Rows are copied in here, one per valid line of the export, then merged into
+# checkins in one statement. It goes away when the import commits.
+STAGING = """
+    create temp table checkin_import (
+        line integer not null,
+        name text not null,
+        local_time timestamp not null,
+        tz text not null,
+        tier text not null,
+        day_of_week text not null,
+        text text,
+        challenge_week_id integer not null,
+        challenger integer not null,
+        time timestamptz generated always as (local_time at time zone tz) stored
+    ) on commit drop
+"""
+
+# (column, type) in the order stage returns them, for a binary COPY
+STAGED_COLUMNS = (
+    ("line", "int4"),
+    ("name", "text"),
+    ("local_time", "timestamp"),
+    ("tz", "text"),
+    ("tier", "text"),
+    ("day_of_week", "text"),
+    ("text", "text"),
+    ("challenge_week_id", "int4"),
+    ("challenger", "int4"),
+)
+
+# Every line but the first for the same challenger and time
+DUPLICATES = """
+    with ranked as (
+        select line, min(line) over (partition by challenger, time) as first
+        from checkin_import
+    ), deleted as (
+        delete from checkin_import s
+        using ranked r
+        where r.line = s.line and r.first <> s.line
+        returning s.line, r.first
+    )
+    select line, first from deleted order by line
+"""
+
+ALREADY_IMPORTED = """
+    with deleted as (
+        delete from checkin_import s
+        using checkins c
+        where c.challenger = s.challenger and c.time = s.time
+        returning s.line, c.id
+    )
+    select line, id from deleted order by line
+"""
+
+# Checkins inserted per challenge, in index order, which makes a big import a
+# third quicker. Anything checked in since ALREADY_IMPORTED ran is left as it is.
+MERGE = """
+    with inserted as (
+        insert into checkins
+            (name, time, tier, day_of_week, text, challenge_week_id, challenger, tz)
+        select name, time, tier, day_of_week, text, challenge_week_id, challenger, tz
+        from checkin_import
+        order by challenge_week_id, challenger, time
+        on conflict (challenger, time) do nothing
+        returning challenge_week_id
+    )
+    select cw.challenge_id, count(*) as inserted
+    from inserted i
+    join challenge_weeks cw on cw.id = i.challenge_week_id
+    group by cw.challenge_id
+    order by cw.challenge_id
+"""
+
+
+class Rejected(NamedTuple):
+    line: int
+    reason: str
+
+    def __str__(self):
+        return "line %s: %s" % (self.line, self.reason)
+
+
+def read_rows(path):
+    """(line, row) for each checkin in a .csv export with a header row, a
+    .jsonl export or a .json list of objects"""
+    if path.endswith(".csv"):
+        with open(path, newline="", encoding="utf-8-sig") as f:
+            reader = csv.DictReader(f)
+            reader.fieldnames = [name.strip().lower() for name in reader.fieldnames or []]
+            for row in reader:
+                yield reader.line_num, row
+    elif path.endswith(".jsonl"):
+        with open(path, encoding="utf-8") as f:
+            for line, text in enumerate(f, 1):
+                if text.strip():
+                    try:
+                        yield line, json.loads(text)
+                    except ValueError:
+                        yield line, None
+    else:
+        with open(path, encoding="utf-8") as f:
+            yield from enumerate(json.load(f), 1)
+
+
+def parse_time(value, zone):
+    """value as a naive time local to zone, or None if it isn't a time"""
+    if not isinstance(value, str):
+        return None
+    value = value.strip()
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        for time_format in TIME_FORMATS:
+            try:
+                parsed = datetime.strptime(value, time_format)
+                break
+            except ValueError:
+                pass
+        else:
+            return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(zone).replace(tzinfo=None)
+    return parsed
+
+
+def stage(line, row, challengers, calendar):
+    """The checkin_import row for one row of an export, or why it's rejected.
+    A blank tier is read from the text the way checkin messages are."""
+    if not isinstance(row, dict):
+        return Rejected(line, "not a checkin")
+    name = str(row.get("name") or "").strip()
+    challenger = challengers.get(name.lower())
+    if challenger is None:
+        return Rejected(line, "unknown challenger %r" % name)
+    text = row.get("text")
+    text = str(text) if text else None
+    tier = str(row.get("tier") or "").strip().upper()
+    if not tier and text is not None:
+        tier = classify(text).tier or ""
+    if tier.isdigit():
+        tier = "T" + tier
+    if TIER.fullmatch(tier) is None:
+        return Rejected(line, "bad tier %r" % row.get("tier"))
+    local_time = parse_time(row.get("time"), challenger.zone)
+    if local_time is None:
+        return Rejected(line, "bad time %r" % row.get("time"))
+    week = calendar.week_on(local_time.date())
+    if week is None:
+        return Rejected(line, "no challenge week on %s" % local_time.date())
+    return (
+        line,
+        challenger.name,
+        local_time,
+        challenger.tz,
+        tier,
+        DAYS[local_time.weekday()],
+        text,
+        week.id,
+        challenger.id,
+    )
+
+
+def import_checkins(path, dry_run=False, report=logging.info):
+    """Imports an export of checkins (name, time, tier and text) in one
+    transaction, reporting each row that's rejected: invalid ones, repeats
+    of an earlier row and checkins that are already there.
+
+    Rows are validated against challengers and the challenge calendar in
+    memory, copied into a staging table, deduplicated and merged into
+    checkins with one insert, then the scores of every challenge they
+    landed in are rebuilt. With dry_run nothing is merged. Returns counts of
+    what happened to the rows."""
+    challengers = {
+        row.name.lower(): Identity(row.id, row.name, row.tz, pytz.timezone(row.tz))
+        for row in fetchall("select id, name, tz from challengers")
+    }
+    calendar = get_calendar()
+    counts = {
+        "read": 0,
+        "rejected": 0,
+        "duplicates": 0,
+        "already imported": 0,
+        "inserted": 0,
+    }
+
+    def fn(conn, cur):
+        started = time.perf_counter()
+        cur.execute(STAGING)
+        staged = 0
+        with cur.copy(
+            "copy checkin_import (%s) from stdin (format binary)"
+            % ", ".join(column for column, _ in STAGED_COLUMNS)
+        ) as copy:
+            copy.set_types([column_type for _, column_type in STAGED_COLUMNS])
+            for line, row in read_rows(path):
+                counts["read"] += 1
+                result = stage(line, row, challengers, calendar)
+                if isinstance(result, Rejected):
+                    counts["rejected"] += 1
+                    report(result)
+                    continue
+                copy.write_row(result)
+                staged += 1
+        logging.info("staged %s checkins in %.1fs", staged, time.perf_counter() - started)
+
+        cur.execute(DUPLICATES)
+        for line, first in cur:
+            counts["duplicates"] += 1
+            report(Rejected(line, "duplicate of line %s" % first))
+        cur.execute(ALREADY_IMPORTED)
+        for line, checkin_id in cur:
+            counts["already imported"] += 1
+            report(Rejected(line, "already imported as checkin %s" % checkin_id))
+        if dry_run:
+            return
+
+        cur.execute(MERGE)
+        inserted = cur.fetchall()
+        counts["inserted"] = sum(row.inserted for row in inserted)
+        counts["already imported"] += (
+            staged - counts["duplicates"] - counts["already imported"] - counts["inserted"]
+        )
+        for row in inserted:
+            notify_change(cur, "checkins", challenge_id=row.challenge_id)
+            rebuild_scores(cur, row.challenge_id)
+        logging.info("imported %s in %.1fs", path, time.perf_counter() - started)
+
+    with_psycopg(fn)
+    logging.info("imported %s: %s", path, counts)
+    return counts
+
+
+if __name__ == "__main__":
+    # python import_checkins.py <export.csv|.json|.jsonl> [--dry-run]
+    parser = argparse.ArgumentParser(
+        description="Import an export of checkins (name, time, tier, text)"
+    )
+    parser.add_argument("path")
+    parser.add_argument(
+        "--dry-run", action="store_true", help="only report the rows that would be rejected"
+    )
+    args = parser.parse_args()
+
+    counts = import_checkins(args.path, dry_run=args.dry_run, report=print)
+    print(
+        "%s read, %s rejected, %s duplicates, %s already imported, %s inserted"
+        % tuple(counts.values())
+    )
+    sys.exit(0)
@@ -0,0 +1,332 @@
+from base_queries import insert_checkin
+from challenge_calendar import get_calendar
+from classify import classify
+from helpers import with_psycopg
+from identity import challenger_for_email, challenger_for_phone
+from notifications import start_listener
+from datetime import datetime
+from typing import NamedTuple, Optional
+import argparse
+import sqlite3
+import sys
+import time
+import os
+import logging
+
+# The queue lives on local disk so a webhook can be acknowledged without
+# waiting on Postgres. The web and huey containers must share it.
+INGEST_DB = os.environ.get("INGEST_DB", "ingest.db")
+# Messages classified and inserted per Postgres transaction
+INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", 50))
+# Pending messages looked at per batch, so senders waiting out a retry can be
+# stepped over
+INGEST_SCAN_LIMIT = int(os.environ.get("INGEST_SCAN_LIMIT", 1000))
+# Retries wait INGEST_RETRY_DELAY seconds, doubling up to INGEST_RETRY_MAX_DELAY,
+# and a message is given up on after INGEST_MAX_ATTEMPTS. Only failures of the
+# message itself count: while Postgres can't be reached messages just wait,
+# about as long again as they already have, up to INGEST_RETRY_MAX_DELAY.
+INGEST_RETRY_DELAY = float(os.environ.get("INGEST_RETRY_DELAY", 5))
+INGEST_RETRY_MAX_DELAY = float(os.environ.get("INGEST_RETRY_MAX_DELAY", 600))
+INGEST_MAX_ATTEMPTS = int(os.environ.get("INGEST_MAX_ATTEMPTS", 10))
+# Twilio and forwardemail retry slow webhooks. A message with the same
+# MessageSid or Message-ID from the same sender within this many seconds is
+# only queued once.
+INGEST_DEDUPE_WINDOW = float(os.environ.get("INGEST_DEDUPE_WINDOW", 3600))
+# Mail without a Message-ID is told apart by its text's checksum, which a
+# second, real checkin can share, so only quick repeats of it are dropped
+INGEST_CONTENT_DEDUPE_WINDOW = float(
+    os.environ.get("INGEST_CONTENT_DEDUPE_WINDOW", 60)
+)
+# How long processed messages are kept around for lag stats and debugging
+INGEST_RETENTION_DAYS = float(os.environ.get("INGEST_RETENTION_DAYS", 7))
+
+SCHEMA = """
+create table if not exists inbound (
+  id integer primary key autoincrement,
+  source text not null,
+  sender text not null,
+  message text not null,
+  external_id text,
+  received_at real not null,
+  status text not null default 'pending',
+  attempts integer not null default 0,
+  next_attempt_at real not null default 0,
+  processed_at real,
+  result text
+);
+create index if not exists inbound_status on inbound (status, id);
+create index if not exists inbound_external_id on inbound (external_id);
+"""
+
+
+class Inbound(NamedTuple):
+    id: int
+    source: str
+    sender: str
+    message: str
+    external_id: Optional[str]
+    received_at: float
+    status: str
+    attempts: int
+    next_attempt_at: float
+    processed_at: Optional[float]
+    result: Optional[str]
+
+
+def connect(path=None):
+    conn = sqlite3.connect(path or INGEST_DB, timeout=10, isolation_level=None)
+    # an acknowledged message has to survive a crash
+    conn.execute("pragma journal_mode = wal")
+    conn.execute("pragma synchronous = full")
+    conn.executescript(SCHEMA)
+    conn.row_factory = lambda cursor, row: Inbound(*row)
+    return conn
+
+
+def enqueue(source, sender, message, external_id=None, dedupe_window=None):
+    """Persists an inbound SMS or email for the consumer. Returns its id and
+    whether the same external_id had already been queued within
+    dedupe_window seconds (INGEST_DEDUPE_WINDOW by default)."""
+    now = time.time()
+    if dedupe_window is None:
+        dedupe_window = INGEST_DEDUPE_WINDOW
+    conn = connect()
+    try:
+        # so two workers given the same retry can't both queue it
+        conn.execute("begin immediate")
+        if external_id is not None:
+            queued = conn.execute(
+                "select * from inbound where external_id = ? and source = ? "
+                "and sender = ? and received_at > ? order by id limit 1",
+                (external_id, source, sender, now - dedupe_window),
+            ).fetchone()
+            if queued is not None:
+                conn.execute("commit")
+                return queued.id, True
+        inbound_id = conn.execute(
+            "insert into inbound (source, sender, message, external_id, received_at) "
+            "values (?, ?, ?, ?, ?)",
+            (source, sender, message, external_id, now),
+        ).lastrowid
+        conn.execute("commit")
+        return inbound_id, False
+    finally:
+        conn.close()
+
+
+def handle(conn, cur, inbound):
+    """Classifies one message and inserts its checkin, returning what
+    happened. Raises if it should be tried again."""
+    is_checkin, tier, reason = classify(inbound.message)
+    if not is_checkin or tier is None:
+        return reason
+    if inbound.source == "mail":
+        challenger = challenger_for_email(inbound.sender)
+    else:
+        challenger = challenger_for_phone(inbound.sender)
+    if challenger is None:
+        return "unknown sender"
+    # checked in when the message arrived, not when it's processed
+    received = datetime.fromtimestamp(inbound.received_at, tz=challenger.zone)
+    week = get_calendar().week_at(received, challenger.tz)
+    if week is None:
+        return "no challenge week"
+    logging.info(
+        "INGEST: %s checkin %s from %s for week %s",
+        inbound.source,
+        tier,
+        challenger.name,
+        week.id,
+    )
+    checkin_id = insert_checkin(
+        inbound.message, tier, challenger, week.id, received.strftime("%A"), received
+    )(conn, cur)
+    return "inserted" if checkin_id is not None else "already inserted"
+
+
+def next_batch(queue, size, now):
+    """Up to size due messages, oldest first. Once a sender has a message
+    waiting to be retried none of their later ones are due, so each sender's
+    checkins go in in the order they were sent."""
+    waiting, batch = set(), []
+    for inbound in queue.execute(
+        "select * from inbound where status = 'pending' order by id limit ?",
+        (INGEST_SCAN_LIMIT,),
+    ):
+        if inbound.sender in waiting:
+            continue
+        if inbound.next_attempt_at > now:
+            waiting.add(inbound.sender)
+            continue
+        batch.append(inbound)
+        if len(batch) == size:
+            break
+    return batch
+
+
+def process(batch):
+    """Inserts a batch in one transaction, each message in a savepoint so a
+    failure only holds back that sender's later messages. Returns
+    {id: (status, result)} for the messages that were tried, with status
+    "deferred" for all of them when the batch as a whole failed."""
+    outcomes = {}
+
+    def fn(conn, cur):
+        held = set()
+        # the outer block makes each message's block a savepoint in it
+        with conn.transaction():
+            for inbound in batch:
+                if inbound.sender in held:
+                    continue
+                try:
+                    with conn.transaction():
+                        outcomes[inbound.id] = ("done", handle(conn, cur, inbound))
+                except Exception as e:
+                    logging.exception("INGEST: message %s failed", inbound.id)
+                    held.add(inbound.sender)
+                    outcomes[inbound.id] = ("retry", repr(e))
+
+    try:
+        with_psycopg(fn)
+    except Exception as e:
+        # nothing committed, so everything goes again, none of it to blame
+        logging.exception("INGEST: batch of %s failed", len(batch))
+        outcomes = {inbound.id: ("deferred", repr(e)) for inbound in batch}
+    return outcomes
+
+
+def retry_delay(attempts):
+    return min(INGEST_RETRY_DELAY * 2 ** (attempts - 1), INGEST_RETRY_MAX_DELAY)
+
+
+def deferred_delay(inbound, now):
+    waited = now - inbound.received_at
+    return min(max(waited, INGEST_RETRY_DELAY), INGEST_RETRY_MAX_DELAY)
+
+
+def record(queue, batch, outcomes, now):
+    queue.execute("begin immediate")
+    for inbound in batch:
+        if inbound.id not in outcomes:
+            continue
+        status, result = outcomes[inbound.id]
+        if status == "done":
+            queue.execute(
+                "update inbound set status = 'done', attempts = attempts + 1, "
+                "processed_at = ?, result = ? where id = ?",
+                (now, result, inbound.id),
+            )
+            continue
+        if status == "deferred":
+            queue.execute(
+                "update inbound set next_attempt_at = ?, result = ? where id = ?",
+                (now + deferred_delay(inbound, now), result, inbound.id),
+            )
+            continue
+        attempts = inbound.attempts + 1
+        status = "pending"
+        if attempts >= INGEST_MAX_ATTEMPTS:
+            logging.error("INGEST: giving up on message %s: %s", inbound.id, result)
+            status = "failed"
+        queue.execute(
+            "update inbound set status = ?, attempts = ?, next_attempt_at = ?, "
+            "result = ? where id = ?",
+            (status, attempts, now + retry_delay(attempts), result, inbound.id),
+        )
+    queue.execute("commit")
+
+
+def drain(batch_size=None):
+    """Processes due messages in batches until none are left and returns how
+    many were tried"""
+    # so cached senders hear about timezone changes
+    start_listener()
+    queue = connect()
+    tried = 0
+    try:
+        while True:
+            batch = next_batch(queue, batch_size or INGEST_BATCH_SIZE, time.time())
+            if not batch:
+                return tried
+            outcomes = process(batch)
+            record(queue, batch, outcomes, time.time())
+            tried += len(outcomes)
+            if not any(status == "done" for status, _ in outcomes.values()):
+                # only failures: leave the rest until their retries are due
+                return tried
+    finally:
+        queue.close()
+
+
+def requeue(ids=None):
+    """Puts failed messages (all of them, or just ids) back in the queue with
+    their attempts reset, returning how many"""
+    queue = connect()
+    try:
+        sql = (
+            "update inbound set status = 'pending', attempts = 0, "
+            "next_attempt_at = 0 where status = 'failed'"
+        )
+        if ids:
+            sql += " and id in (%s)" % ", ".join("?" * len(ids))
+        return queue.execute(sql, tuple(ids or ())).rowcount
+    finally:
+        queue.close()
+
+
+def prune(now=None):
+    """Forgets processed messages older than INGEST_RETENTION_DAYS"""
+    now = now or time.time()
+    queue = connect()
+    try:
+        return queue.execute(
+            "delete from inbound where status = 'done' and processed_at < ?",
+            (now - INGEST_RETENTION_DAYS * 86400,),
+        ).rowcount
+    finally:
+        queue.close()
+
+
+def stats(now=None):
+    """Queue depth and processing lag, in seconds"""
+    now = now or time.time()
+    queue = connect()
+    queue.row_factory = None
+    try:
+        depth, due, oldest = queue.execute(
+            "select count(*), count(*) filter (where next_attempt_at <= ?), "
+            "min(received_at) from inbound where status = 'pending'",
+            (now,),
+        ).fetchone()
+        (failed,) = queue.execute(
+            "select count(*) from inbound where status = 'failed'"
+        ).fetchone()
+        processed, average_lag, max_lag = queue.execute(
+            "select count(*), avg(processed_at - received_at), max(processed_at - received_at) "
+            "from inbound where status = 'done' and processed_at >= ?",
+            (now - 3600,),
+        ).fetchone()
+    finally:
+        queue.close()
+    return {
+        "depth": depth,
+        "due": due,
+        "failed": failed,
+        "oldest_pending_age": None if oldest is None else round(now - oldest, 3),
+        "processed_last_hour": processed,
+        "average_lag_last_hour": None if average_lag is None else round(average_lag, 3),
+        "max_lag_last_hour": None if max_lag is None else round(max_lag, 3),
+    }
+
+
+if __name__ == "__main__":
+    # python ingest.py requeue [<inbound_id>...]
+    parser = argparse.ArgumentParser(description="Maintain the inbound queue")
+    parser.add_argument("command", choices=["requeue"])
+    parser.add_argument(
+        "inbound_id", type=int, nargs="*", help="failed messages to retry (default all)"
+    )
+    args = parser.parse_args()
+
+    print("requeued %s messages" % requeue(args.inbound_id))
+    sys.exit(0)
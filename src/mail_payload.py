@@ -0,0 +1,378 @@
+from tempfile import SpooledTemporaryFile
+from typing import Dict, NamedTuple, Optional, Tuple
+import codecs
+import hashlib
+import itertools
+import json
+import os
+import re
+import time
+
+# forwardemail posts the whole message, every attachment spelled out as a JSON
+# list of byte values. Bigger request bodies are refused.
+MAIL_MAX_BYTES = int(os.environ.get("MAIL_MAX_BYTES", 32 * 1024 * 1024))
+# The most text a checkin attachment can have
+MAIL_MAX_TEXT_BYTES = int(os.environ.get("MAIL_MAX_TEXT_BYTES", 256 * 1024))
+# Bodies are kept in memory up to this size while they're read, then on disk
+MAIL_SPOOL_BYTES = int(os.environ.get("MAIL_SPOOL_BYTES", 1024 * 1024))
+
+CHUNK = 64 * 1024
+# Keys and the values we keep are short; anything longer is skipped unread
+MAX_KEPT_STRING = 4096
+MAX_DEPTH = 64
+
+WHITESPACE = re.compile(rb"[ \t\r\n]*")
+LITERAL = re.compile(rb"-?[0-9][0-9.eE+-]*|true|false|null")
+NOT_BYTE_LIST = re.compile(rb"[^0-9, \t\r\n]")
+
+
+class PayloadTooLarge(Exception):
+    pass
+
+
+class BadPayload(ValueError):
+    pass
+
+
+class Attachment(NamedTuple):
+    content_type: Optional[str]
+    checksum: Optional[str]
+    # content.type, "Buffer" when content.data is a list of bytes
+    buffer_type: Optional[str]
+    # where content.data's list is in the spooled body, between its brackets
+    data: Optional[Tuple[int, int]]
+
+
+class MailPayload(NamedTuple):
+    sender: Optional[str]
+    mta: Optional[str]
+    # the Message-ID header
+    message_id: Optional[str]
+    attachments: list
+    # the request body, for read_text
+    spool: SpooledTemporaryFile
+
+
+# (path, how it's stored) for each value mail() needs, with None for the
+# attachment's index
+KEPT = {
+    ("from", "text"): "sender",
+    ("session", "mta"): "mta",
+    ("messageId",): "message_id",
+    ("attachments", None, "contentType"): "content_type",
+    ("attachments", None, "checksum"): "checksum",
+    ("attachments", None, "content", "type"): "buffer_type",
+}
+DATA = ("attachments", None, "content", "data")
+
+
+def _pattern(path):
+    if len(path) > 1 and path[0] == "attachments" and isinstance(path[1], int):
+        return path[1], ("attachments", None) + path[2:]
+    return None, path
+
+
+class _Scanner:
+    """Reads a JSON body from stream into spool, keeping only what KEPT
+    names and where DATA's byte lists are. Everything else, attachment bytes
+    and HTML bodies included, is skipped without being decoded."""
+
+    def __init__(self, stream, spool, max_bytes):
+        self.stream = stream
+        self.spool = spool
+        self.max_bytes = max_bytes
+        self.buf = b""
+        self.pos = 0
+        # offset of buf[0] in the body
+        self.base = 0
+        self.kept = {}
+        self.attachments: Dict[int, dict] = {}
+
+    def fill(self):
+        chunk = self.stream.read(CHUNK)
+        if not chunk:
+            return False
+        if self.base + len(self.buf) + len(chunk) > self.max_bytes:
+            raise PayloadTooLarge()
+        self.spool.write(chunk)
+        self.base += self.pos
+        self.buf = self.buf[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            self.pos = WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos : self.pos + 1]
+            if not self.fill():
+                raise BadPayload("unexpected end of body")
+
+    def expect(self, token):
+        if self.peek() != token:
+            raise BadPayload("expected %r at %s" % (token, self.base + self.pos))
+        self.pos += 1
+
+    def string(self, keep):
+        """The string starting after the quote at pos, decoded if keep"""
+        parts = []
+        size = 0
+        while True:
+            end = self.buf.find(b'"', self.pos)
+            while end >= 0 and _escaped(self.buf, end, self.pos):
+                end = self.buf.find(b'"', end + 1)
+            cut = end
+            if end < 0:
+                # a trailing backslash might escape the next chunk's quote
+                cut = len(self.buf)
+                while cut > self.pos and self.buf[cut - 1] == 92:
+                    cut -= 1
+            if keep:
+                size += cut - self.pos
+                if size > MAX_KEPT_STRING:
+                    raise BadPayload("string too long at %s" % (self.base + self.pos))
+                parts.append(self.buf[self.pos : cut])
+            if end >= 0:
+                self.pos = end + 1
+                break
+            self.pos = cut
+            if not self.fill():
+                raise BadPayload("unterminated string")
+        if keep:
+            try:
+                return json.loads(b'"' + b"".join(parts) + b'"')
+            except ValueError as e:
+                raise BadPayload(str(e))
+
+    def byte_list(self):
+        """Skips a list of byte values, returning where it is in the body"""
+        start = self.base + self.pos
+        while True:
+            end = self.buf.find(b"]", self.pos)
+            if NOT_BYTE_LIST.search(self.buf, self.pos, len(self.buf) if end < 0 else end):
+                raise BadPayload("not a list of bytes at %s" % start)
+            if end >= 0:
+                self.pos = end + 1
+                return start, self.base + end
+            self.pos = len(self.buf)
+            if not self.fill():
+                raise BadPayload("unterminated list")
+
+    def literal(self):
+        while True:
+            match = LITERAL.match(self.buf, self.pos)
+            # a number might carry on into the next chunk
+            if match and match.end() < len(self.buf):
+                self.pos = match.end()
+                return
+            if not self.fill():
+                if match:
+                    self.pos = match.end()
+                    return
+                raise BadPayload("unexpected %r" % self.buf[self.pos : self.pos + 10])
+
+    def value(self, path):
+        if len(path) > MAX_DEPTH:
+            raise BadPayload("nested too deep")
+        index, pattern = _pattern(path)
+        token = self.peek()
+        self.pos += 1
+        if token == b"{":
+            if self.peek() == b"}":
+                self.pos += 1
+                return
+            while True:
+                self.expect(b'"')
+                key = self.string(keep=True)
+                self.expect(b":")
+                self.value(path + (key,))
+                token = self.peek()
+                self.pos += 1
+                if token == b"}":
+                    return
+                if token != b",":
+                    raise BadPayload("expected , or } at %s" % (self.base + self.pos))
+        elif token == b"[":
+            if pattern == DATA:
+                self.attachments.setdefault(index, {})["data"] = self.byte_list()
+                return
+            if self.peek() == b"]":
+                self.pos += 1
+                return
+            for n in itertools.count():
+                self.value(path + (n,))
+                token = self.peek()
+                self.pos += 1
+                if token == b"]":
+                    return
+                if token != b",":
+                    raise BadPayload("expected , or ] at %s" % (self.base + self.pos))
+        elif token == b'"':
+            field = KEPT.get(pattern)
+            value = self.string(keep=field is not None)
+            if field is None:
+                return
+            if index is None:
+                self.kept[field] = value
+            else:
+                self.attachments.setdefault(index, {})[field] = value
+        else:
+            self.pos -= 1
+            self.literal()
+
+
+def _escaped(buf, end, start):
+    backslashes = 0
+    while end - backslashes > start and buf[end - backslashes - 1] == 92:
+        backslashes += 1
+    return backslashes % 2 == 1
+
+
+def parse(stream, max_bytes=None):
+    """Reads a forwardemail webhook body from stream, never holding more than
+    a chunk of it or any attachment in memory. Raises PayloadTooLarge past
+    max_bytes (MAIL_MAX_BYTES) and BadPayload if it isn't JSON."""
+    spool = SpooledTemporaryFile(max_size=MAIL_SPOOL_BYTES)
+    scanner = _Scanner(stream, spool, max_bytes or MAIL_MAX_BYTES)
+    try:
+        scanner.value(())
+    except Exception:
+        spool.close()
+        raise
+    attachments = [
+        Attachment(
+            fields.get("content_type"),
+            fields.get("checksum"),
+            fields.get("buffer_type"),
+            fields.get("data"),
+        )
+        for _, fields in sorted(scanner.attachments.items())
+    ]
+    return MailPayload(
+        scanner.kept.get("sender"),
+        scanner.kept.get("mta"),
+        scanner.kept.get("message_id"),
+        attachments,
+        spool,
+    )
+
+
+def read_text(payload, attachment, max_bytes=None):
+    """(text, md5 hex digest) of an attachment's bytes, read back from the
+    spooled body a chunk at a time. text is None if it isn't UTF-8."""
+    max_bytes = max_bytes or MAIL_MAX_TEXT_BYTES
+    md5 = hashlib.md5()
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    parts = []
+    size = 0
+    start, end = attachment.data
+    spool = payload.spool
+    spool.seek(start)
+    remaining = end - start
+    carry = b""
+    while True:
+        chunk = carry + spool.read(min(CHUNK, remaining))
+        remaining -= len(chunk) - len(carry)
+        # a value cut off at the end of the chunk waits for the next one
+        cut = chunk.rfind(b",") + 1 if remaining else len(chunk)
+        carry = chunk[cut:]
+        values = chunk[:cut].split(b",")
+        if not values[-1].strip():
+            values.pop()
+        try:
+            data = bytes(map(int, values))
+        except ValueError:
+            raise BadPayload("not a list of bytes")
+        size += len(data)
+        if size > max_bytes:
+            raise PayloadTooLarge()
+        md5.update(data)
+        if parts is not None:
+            try:
+                parts.append(decoder.decode(data, final=not remaining))
+            except UnicodeDecodeError:
+                parts = None
+        if not remaining:
+            break
+    return None if parts is None else "".join(parts), md5.hexdigest()
+
+
+def legacy_read(body):
+    """How mail() read a body before, to benchmark against"""
+    payload = json.loads(body)
+    first_text_plain = next(
+        (a for a in payload["attachments"] if a["contentType"] == "text/plain"), None
+    )
+    bdata = bytearray(first_text_plain["content"]["data"])
+    md5 = hashlib.md5()
+    md5.update(bdata)
+    return bdata.decode("utf-8"), md5.hexdigest()
+
+
+def streamed_read(body):
+    import io
+
+    payload = parse(io.BytesIO(body))
+    with payload.spool:
+        attachment = next(
+            a for a in payload.attachments if a.content_type == "text/plain"
+        )
+        return read_text(payload, attachment)
+
+
+def sample(image_bytes, text="T3 checkin"):
+    """A forwardemail body with an image_bytes image before a text/plain
+    attachment, and the HTML and raw message mail clients send along"""
+    image = os.urandom(image_bytes)
+    html = "<p>" + "lorem ipsum " * (image_bytes // 48) + "</p>"
+
+    def attachment(content_type, data):
+        return {
+            "type": "attachment",
+            "content": {"type": "Buffer", "data": list(data)},
+            "contentType": content_type,
+            "contentDisposition": "attachment",
+            "filename": "x",
+            "headers": {},
+            "checksum": hashlib.md5(data).hexdigest(),
+            "size": len(data),
+        }
+
+    return json.dumps(
+        {
+            "attachments": [
+                attachment("image/jpeg", image),
+                attachment("text/plain", text.encode()),
+            ],
+            "html": html,
+            "textAsHtml": html,
+            "from": {"text": "5550000000@tmomail.net"},
+            "raw": "Content-Type: multipart/mixed\n\n" + "A" * (image_bytes // 4),
+            "session": {"mta": "mx1.forwardemail.net"},
+        }
+    ).encode()
+
+
+if __name__ == "__main__":
+    # python mail_payload.py times reading multi-megabyte bodies and their
+    # peak memory the old way and streamed
+    import tracemalloc
+
+    print("%-10s %-10s %10s %12s" % ("body", "", "time", "peak memory"))
+    for megabytes in [1, 5, 20]:
+        body = sample(megabytes * 1024 * 1024 // 4)
+        results = []
+        for name, read in [("json", legacy_read), ("streamed", streamed_read)]:
+            start = time.perf_counter()
+            result = read(body)
+            elapsed = time.perf_counter() - start
+            tracemalloc.start()
+            read(body)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results.append(result)
+            print(
+                "%-10s %-10s %8.0fms %10.1fMB"
+                % ("%.0fMB" % (len(body) / 1e6), name, elapsed * 1000, peak / 1e6)
+            )
+        assert results[0] == results[1], results
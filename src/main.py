@@ -4,30 +4,80 @@ import os
 import itertools
 from datetime import datetime, timedelta, date
 import json
-from flask import Flask, render_template, request, url_for, redirect
+from flask import Flask, Response, abort, g, render_template, request, url_for, redirect
 import logging
 from rule_sets import calculate_total_score
-from chart import checkin_chart, week_heat_map_from_checkins, write_og_image
-import hashlib
-from helpers import fetchall, fetchone, with_psycopg
+from chart import checkin_chart, week_heat_map_from_checkins
+from previews import preview_png, request_preview
+from rasterizer import RasterizerBusy, RasterizerTimeout, rasterizer
+from season import load_season, season_chart, season_stats
+import mail_payload
+from helpers import fetchall, fetchone, with_psycopg, gather, close_session
 from base_queries import *
-import re
 import pytz
+import ingest
+from tasks import drain_inbound
 from twilio_decorator import twilio_request
-from cache_decorator import last_modified
+from cache_decorator import last_modified, cached_render, render_cache
 from green import determine_if_green
+from challenge_calendar import get_calendar, invalidate as invalidate_calendar
+from notifications import notify_change, start_listener
+from identity import invalidate as invalidate_identity
 
 LOGLEVEL = os.environ.get("LOGLEVEL", "WARNING").upper()
+# How long browsers and crawlers may reuse a /preview PNG without asking again
+PREVIEW_MAX_AGE = int(os.environ.get("PREVIEW_MAX_AGE", 300))
 logging.basicConfig(level="DEBUG")
 
 app = Flask(__name__)
+app.teardown_appcontext(close_session)
+app.before_request(start_listener)
+
+
+def details_validators():
+    challenge_id = request.args.get("challenge_id", type=int)
+    if challenge_id not in get_calendar().challenges_by_id:
+        abort(404)
+    return challenge_validators(challenge_id)
+
+
+def selected_challenge():
+    """The challenge picked in the query string, defaulting to the current one"""
+    calendar = get_calendar()
+    challenge_name = request.args.get("challenge")
+    if challenge_name is None:
+        return calendar.challenge_at()
+    return calendar.challenges_by_name.get(challenge_name)
+
+
+def selected_challenge_and_week():
+    """The challenge and week id picked in the query string, defaulting to the
+    current ones"""
+    calendar = get_calendar()
+    challenge = selected_challenge()
+    challenge_name = request.args.get("challenge")
+    week_id = request.args.get("challenge_week_%s" % challenge_name)
+    if week_id is None:
+        week_id = calendar.week_at().id
+    return challenge, int(week_id)
+
+
+def index_validators():
+    challenge, week_id = selected_challenge_and_week()
+    return challenge_validators(challenge.id, week_id)
 
 
 @app.route("/details")
+@last_modified(details_validators)
+@cached_render
 def details():
-    challenge_id = request.args.get("challenge_id")
-    challenge = challenge_data(challenge_id)
-    logging.debug("Challenge ID: %s %s", challenge_id, challenge)
+    calendar = get_calendar()
+    challenge = calendar.challenges_by_id.get(request.args.get("challenge_id", type=int))
+    if challenge is None:
+        abort(404)
+    details = challenge_details(challenge.id)
+    logging.debug("Challenge: %s %s", challenge.id, details)
+    g.challenge_id = challenge.id
     weeksSinceStart = (
         min(
             math.ceil((date.today() - challenge.start).days / 7),
@@ -36,50 +86,28 @@ def details():
         - challenge.bi_weeks
     )
     logging.debug("Weeks since start: %s", weeksSinceStart)
-    points = points_so_far(challenge_id)
-    logging.info("points so far: %s", weeksSinceStart)
-    t3 = [x for x in points if x.tier == "T3"]
-    t3 = sorted(t3, key=lambda x: -x.points)
-    t2 = [x for x in points if x.tier == "T2"]
-    t2 = sorted(t2, key=lambda x: -x.points)
-    floating = [x for x in points if x.tier == "floating"]
-    floating = sorted(floating, key=lambda x: -x.points)
-    checkins_to_subtract = bi_checkins(challenge_id)
-    knocked_out = points_knocked_out(challenge_id)
-    total_points_t2 = sum(x.points for x in t2)
-    total_points_t3 = sum(x.points for x in t3)
-    total_points_floating = sum(x.points for x in floating) - checkins_to_subtract
-    ante_floating = total_ante(challenge_id, "floating")
-    ante_t2 = total_ante(challenge_id, "T2")
-    ante_t3 = total_ante(challenge_id, "T3")
-    dollars_per_point_floating = (
-        ante_floating / total_points_floating if total_points_floating > 0 else 0
-    )
-    dollars_per_point_t2 = ante_t2 / total_points_t2 if total_points_t2 > 0 else 0
-    dollars_per_point_t3 = ante_t3 / total_points_t3 if total_points_t3 > 0 else 0
-
-    points = sorted(points, key=lambda x: -x.points)
-    logging.debug("points: %s", points)
-    challenges = get_challenges()
+    t2, t3, floating = details.pots["T2"], details.pots["T3"], details.pots["floating"]
     return render_template(
         "details.html",
-        t2=t2,
-        t3=t3,
-        floating=floating,
-        total_points_t2=total_points_t2,
-        dollars_per_point_t2=dollars_per_point_t2,
-        total_ante_t2=int(dollars_per_point_t2 * total_points_t2),
-        total_points_t3=total_points_t3,
-        dollars_per_point_t3=dollars_per_point_t3,
-        total_ante_t3=int(dollars_per_point_t3 * total_points_t3),
-        total_points_floating=total_points_floating,
-        dollars_per_point_floating=dollars_per_point_floating,
-        total_ante_floating=int(dollars_per_point_floating * total_points_floating),
+        t2=t2.scores,
+        t3=t3.scores,
+        floating=floating.scores,
+        total_points_t2=t2.points,
+        dollars_per_point_t2=t2.dollars_per_point,
+        total_ante_t2=t2.payout,
+        total_points_t3=t3.points,
+        dollars_per_point_t3=t3.dollars_per_point,
+        total_ante_t3=t3.payout,
+        total_points_floating=floating.points,
+        dollars_per_point_floating=floating.dollars_per_point,
+        total_ante_floating=floating.payout,
         challenge=challenge,
-        knocked_out=knocked_out,
+        knocked_out=details.knocked_out,
         weeks=weeksSinceStart,
-        total_floating=total_points_floating,
-        challenges=[c for c in challenges if c.id not in set([1, challenge_id])],
+        total_floating=floating.points,
+        challenges=[
+            c for c in calendar.challenges if c.id not in (1, challenge.id)
+        ],
     )
 
 
@@ -115,8 +143,10 @@ def create_challenge():
                     'insert into challenge_weeks (challenge_id, week_of_year, start, "end") values (%s, %s, %s, %s)',
                     [challenge_id, start.isocalendar()[1], start, end],  # week of year
                 )
+            notify_change(curr, "challenges", challenge_id=challenge_id)
 
         with_psycopg(create)
+        invalidate_calendar()
 
     challengers = fetchall(
         "select * from challengers where bmr is not null order by name"
@@ -124,85 +154,84 @@ def create_challenge():
     return render_template("create_challenge.html", challengers=challengers)
 
 
-@app.route("/")
-@last_modified(
-    "select time::TIMESTAMP as last_modified from checkins order by time desc limit 1"
-)
-def index():
-    challenge_name = request.args.get("challenge")
-    logging.debug("Challenge requested: %s", challenge_name)
-    week_id = request.args.get("challenge_week_%s" % challenge_name)
-    logging.debug("Week requested: %s", week_id)
-    now = datetime.now()
-    current_year = int(now.strftime("%Y"))
-    current_week = int(now.strftime("%W"))
-    current_date = date.today().isoformat()
-
-    current_challenge = None
-    if challenge_name is None:
-        logging.debug(
-            "Getting challenge for current week dates: %s %s %s",
-            current_year,
-            current_week,
-            current_date,
-        )
-        current_challenge = get_current_challenge()
-    else:
-        logging.debug("Getting challenge with name: %s", challenge_name)
-        current_challenge = fetchone(
-            "select * from challenges where name = %s", [challenge_name]
-        )
-
-    logging.info("Current challenge: %s", current_challenge)
-    current_challenge_week = get_current_challenge_week()
-    logging.info("Current challenge week: %s", current_challenge_week)
-
-    if week_id is None:
-        week_id = current_challenge_week.id
-
-    total_points = calculate_total_score(current_challenge.id)
+def week_chart(current_challenge, week_id):
+    """Draws the week's checkin chart, returning it with the week's view and
+    the time of the latest checkin"""
+    calendar = get_calendar()
+    current_challenge_week = calendar.week_at()
+    total_points, selected_week, challenge_score = gather(
+        calculate_total_score.query(current_challenge.id),
+        week_view.query(week_id),
+        points_so_far.query(current_challenge.id),
+    )
 
     logging.debug("Austin points: %s", total_points)
-
-    selected_challenge_week = fetchone(
-        "select * from challenge_weeks where id = %s", [week_id]
-    )
     logging.debug(
         "Selected challenge week: %s is green: %s",
-        selected_challenge_week,
-        selected_challenge_week.green,
+        selected_week.week_id,
+        selected_week.green,
     )
 
-    checkins = checkins_this_week(week_id)
-    logging.debug("Week checkins: %s", [checkin.name for checkin in checkins])
     week, latest, achievements = week_heat_map_from_checkins(
-        checkins,
-        current_challenge.id,
+        selected_week,
         current_challenge.rule_set,
     )
     week = sorted(
         week, key=lambda x: -total_points[x.name] if x.name in total_points else 0
     )
-    total_checkins = {x[1]: x[0] for x in points_so_far(current_challenge.id)}
+    total_checkins = {x[1]: x[0] for x in challenge_score}
     logging.info("TOTAL CHECKINS %s", total_checkins)
     logging.debug("WEEK: %s, LATEST: %s", week, latest)
     chart = checkin_chart(
         week,
         1000,
         600,
-        current_challenge.id,
-        selected_challenge_week.green,
-        selected_challenge_week.bye_week,
+        selected_week.green,
+        selected_week.bye_week,
         total_points,
         achievements,
         total_checkins,
-        total_possible_checkins(current_challenge.id)[0],
-        total_possible_checkins_so_far(current_challenge.id, current_challenge_week.id),
+        calendar.possible_checkins(current_challenge.id),
+        calendar.possible_checkins_so_far(
+            current_challenge.id, current_challenge_week.id
+        ),
+    )
+    return chart, selected_week, latest
+
+
+@app.route("/")
+@last_modified(index_validators)
+@cached_render
+def index():
+    challenge_name = request.args.get("challenge")
+    logging.debug("Challenge requested: %s", challenge_name)
+    week_id = request.args.get("challenge_week_%s" % challenge_name)
+    logging.debug("Week requested: %s", week_id)
+    now = datetime.now()
+    current_year = int(now.strftime("%Y"))
+    current_week = int(now.strftime("%W"))
+    current_date = date.today().isoformat()
+
+    logging.debug(
+        "Getting challenge for current week dates: %s %s %s",
+        current_year,
+        current_week,
+        current_date,
     )
-    write_og_image(chart, week_id)
-    og_path = url_for("static", filename="preview-" + str(week_id) + ".png")
+    calendar = get_calendar()
+    current_challenge, week_id = selected_challenge_and_week()
+    current_challenge_week = calendar.week_at()
+    cws = calendar.week_options
+    logging.info("Current challenge: %s", current_challenge)
+    g.challenge_id = current_challenge.id
+    logging.info("Current challenge week: %s", current_challenge_week)
+
+    chart, selected_week, latest = week_chart(current_challenge, week_id)
+    # crawlers are sent to the route, which renders the preview if the
+    # background render hasn't finished
+    request_preview(week_id, chart)
+    og_path = url_for("preview", week_id=week_id)
     logging.debug("Challenge ID: %s", current_challenge.id)
-    cws = challenge_weeks()
     logging.debug("Weeks: %s", cws)
     current_challenge_weeks = next(v for v in cws if v[0][0] == current_challenge.name)
     logging.info("Current week index: %s", current_challenge_weeks)
@@ -225,10 +254,64 @@ def index():
         current_week_start=current_challenge_weeks[week_index - 1][2].strftime("%m/%d"),
         current_week=current_week,
         viewing_this_week=challenge_name == request.args.get("challenge") == None,
-        green=selected_challenge_week.green,
+        green=selected_week.green,
     )
 
 
+def season_validators():
+    return challenge_validators(selected_challenge().id)
+
+
+@app.route("/season")
+@last_modified(season_validators)
+@cached_render
+def season():
+    challenge = selected_challenge()
+    g.challenge_id = challenge.id
+    selected_season = load_season(challenge.id)
+    stats = season_stats(selected_season, challenge.rule_set)
+    return render_template(
+        "season.html",
+        svg=season_chart(selected_season, stats),
+        challenge=challenge.name,
+        challenges=[c.name for c in get_calendar().challenges],
+    )
+
+
+def preview_validators():
+    week = get_calendar().weeks_by_id.get(request.view_args["week_id"])
+    if week is None:
+        abort(404)
+    return challenge_validators(week.challenge_id, week.id)
+
+
+@app.route("/preview/<int:week_id>.png")
+@last_modified(preview_validators)
+def preview(week_id):
+    calendar = get_calendar()
+    challenge = calendar.challenges_by_id[calendar.weeks_by_id[week_id].challenge_id]
+    chart, _, _ = week_chart(challenge, week_id)
+    try:
+        png = preview_png(week_id, chart)
+    except (RasterizerBusy, RasterizerTimeout):
+        logging.warning("No preview for week %s, the rasterizer is busy", week_id)
+        return Response(status=503, headers={"Retry-After": "10"})
+    response = Response(png, mimetype="image/png")
+    response.cache_control.public = True
+    response.cache_control.max_age = PREVIEW_MAX_AGE
+    return response
+
+
+@app.route("/ingest-stats")
+def ingest_stats():
+    return ingest.stats()
+
+
+@app.route("/cache-stats")
+def cache_stats():
+    return {**render_cache.stats(), "rasterizer": rasterizer.stats()}
+
+
 @app.route("/make-it-green")
 def make_it_green():
     green = determine_if_green()
@@ -247,10 +330,17 @@ def challenger(challenger):
 
         def fn(conn, cur):
             cur.execute(
-                "update challengers set tz = %s where name = %s", [timezone, challenger]
+                "update challengers set tz = %s where name = %s returning id",
+                [timezone, challenger],
             )
-
-        with_psycopg(fn)
+            updated = cur.fetchone()
+            if updated is not None:
+                notify_change(cur, "challengers", challenger_id=updated.id)
+                return updated.id
+
+        challenger_id = with_psycopg(fn)
+        if challenger_id is not None:
+            invalidate_identity(challenger_id)
     c = fetchone("select * from challengers where name = %s", [challenger])
     m = fetchone(
         'select cc.mulligan from challenger_challenges cc join challenges c on c.id = cc.challenge_id and c.start <= CURRENT_DATE and c."end" >= CURRENT_DATE where cc.challenger_id = %s',
@@ -283,13 +373,7 @@ def add_checkin():
     time = datetime.fromisoformat(request.form["time"])
     day_of_week = time.strftime("%A")
     challenger = fetchone("select * from challengers where name = %s", [name])
-    challenge_week_during_sql = """
-        select * from challenge_weeks 
-        where 
-            week_of_year = extract(week from %s at time zone 'America/New_York') and
-            extract(year from start) = extract(year from current_date)
-        """
-    challenge_week = fetchone(challenge_week_during_sql, [time])
+    challenge_week = get_calendar().week_at(time)
     logging.debug(
         "Add checkin: %s",
         {
@@ -314,97 +398,76 @@ def add_checkin():
     return render_template("magic.html")
 
 
-def is_checkin(message):
-    body = message.lower()
-    matches = (
-        re.match(".*((t\\d+)?.?(check.?in.?|✅)|(check.?in.?|✅)(t\\d+)?).*", body)
-        is not None
-    )
-    return (
-        matches
-        and "liked" not in body
-        and "emphasized" not in body
-        and "loved" not in body
-        and "laughed" not in body
-        and 'to "' not in body
-        and "to “" not in body
-    )
-
-
-def get_tier(message):
-    match = re.match(".*(t\\d+).*", message.lower())
-    if match is not None:
-        return match.group(1).upper()
-    return "unknown"
-
-
 @app.route("/mail", methods=["POST"])
 def mail():
-    fromaddress = request.json["from"]["text"]
+    if (request.content_length or 0) > mail_payload.MAIL_MAX_BYTES:
+        logging.error("MAIL: %s bytes is too big", request.content_length)
+        return "too_big", 413
+    try:
+        payload = mail_payload.parse(request.stream)
+    except mail_payload.PayloadTooLarge:
+        logging.error("MAIL: too big")
+        return "too_big", 413
+    except mail_payload.BadPayload as e:
+        logging.error("MAIL: bad payload %s", e)
+        return abort(400)
+    with payload.spool:
+        return queue_mail(payload)
+
+
+def queue_mail(payload):
+    fromaddress = payload.sender
     logging.info("MAIL: weve got mail from %s", fromaddress)
+    if fromaddress is None or fromaddress.count("@") != 1:
+        logging.error("MAIL: bad from address %s", fromaddress)
+        return "bad_from", 200
 
-    sessionmta = request.json["session"]["mta"]
+    sessionmta = payload.mta
     if sessionmta != "mx1.forwardemail.net" and sessionmta != "mx2.forwardemail.net":
         logging.error("MAIL: not from mx1/2, %s", sessionmta)
         return "1", 200
 
-    attachments = request.json["attachments"]
     first_text_plain = next(
         (
             attachment
-            for attachment in attachments
-            if attachment["contentType"] == "text/plain"
+            for attachment in payload.attachments
+            if attachment.content_type == "text/plain"
         ),
         None,
     )
     if first_text_plain is None:
         return "not_text", 200
 
-    content = first_text_plain["content"]
-    checksum = first_text_plain["checksum"]
+    checksum = first_text_plain.checksum
 
-    if content["type"] != "Buffer":
-        logging.error("MAIL: non buffer data %s", content["type"])
+    if first_text_plain.buffer_type != "Buffer" or first_text_plain.data is None:
+        logging.error("MAIL: non buffer data %s", first_text_plain.buffer_type)
         return "2", 200
 
-    bdata = bytearray(content["data"])
-    md5 = hashlib.md5()
-    md5.update(bdata)
-    buffer_checksum = md5.hexdigest()
+    try:
+        message, buffer_checksum = mail_payload.read_text(payload, first_text_plain)
+    except mail_payload.PayloadTooLarge:
+        logging.error("MAIL: text attachment too big")
+        return "too_big", 413
+    except mail_payload.BadPayload as e:
+        logging.error("MAIL: bad attachment %s", e)
+        return abort(400)
 
     if checksum != buffer_checksum:
         logging.error("MAIL: checksum mismatch %s %s", buffer_checksum, checksum)
         return "3", 200
 
-    number, domain = fromaddress.split("@")
-    message = bdata.decode("utf-8")
-
+    if message is None:
+        logging.error("MAIL: attachment isn't utf-8")
+        return abort(400)
     logging.info("MAIL: content %s", message)
-
-    if not is_checkin(message):
-        logging.debug("MAIL: not checkin")
-        return "4", 200
-
-    tier = get_tier(message)
-
-    logging.info("MAIL: tier %s", tier)
-
-    if tier == "unknown":
-        logging.info("MAIL: unknown tier")
-        return "5", 200
-
-    challenger = fetchone(
-        "select * from challengers where phone_number = %s and email_domain = %s",
-        (number, domain),
-    )
-    challenge_week = get_current_challenge_week(challenger.tz)
-
-    logging.info("MAIL: challenger %s", challenger)
-    logging.info("MAIL: challenge week %s", challenge_week.id)
-
-    with_psycopg(insert_checkin(message, tier, challenger, challenge_week.id))
-
-    return "success", 200
+    if payload.message_id:
+        queue_inbound("mail", fromaddress, message, payload.message_id)
+    else:
+        queue_inbound(
+            "mail", fromaddress, message, checksum, ingest.INGEST_CONTENT_DEDUPE_WINDOW
+        )
+    return "queued", 200
 
 
 @app.route("/sms", methods=["POST"])
@@ -414,32 +477,28 @@ def sms():
     phone_number = body.get("From")
     message = body.get("Body")
     logging.info("SMS: %s %s", phone_number, message)
-
-    if not is_checkin(message):
-        logging.debug("SMS: not checkin")
-        return "4", 200
-
-    tier = get_tier(message)
-
-    logging.info("SMS: tier %s", tier)
-
-    if tier == "unknown":
-        logging.info("SMS: unknown tier")
-        return "5", 200
-
-    challenger = fetchone(
-        "select * from challengers where phone_number = %s or phone_number = %s",
-        # check vs +1 and no +1
-        (phone_number, phone_number[2:]),
+    if not phone_number or message is None:
+        return abort(400)
+    queue_inbound("sms", phone_number, message, body.get("MessageSid"))
+    return "queued", 200
+
+
+def queue_inbound(source, sender, message, external_id, dedupe_window=None):
+    """Saves the message for the huey consumer, which classifies it and
+    inserts the checkin, and wakes it up. Retries of a message already saved
+    get the same answer and nothing else."""
+    inbound_id, duplicate = ingest.enqueue(
+        source, sender, message, external_id, dedupe_window
     )
-    challenge_week = get_current_challenge_week(challenger.tz)
-
-    logging.info("SMS: challenger %s", challenger)
-    logging.info("SMS: challenge week %s", challenge_week.id)
-
-    with_psycopg(insert_checkin(message, tier, challenger, challenge_week.id))
-
-    return "success", 200
+    if duplicate:
+        logging.info("%s: %s already queued as %s", source.upper(), external_id, inbound_id)
+        return
+    logging.info("%s: queued as %s", source.upper(), inbound_id)
+    try:
+        drain_inbound()
+    except Exception:
+        # it's saved; the periodic drain will get to it
+        logging.exception("%s: couldn't wake the consumer", source.upper())
 
 
 @app.route("/mulligan/<challenger>", methods=["GET", "POST"])
@@ -450,10 +509,19 @@ def mulligan(challenger):
     def insert_checkin_and_associate_mulligan(conn, cur):
         m = insert_checkin("MULLIGAN T1 checkin", "T1", c, challenge_week.id)(conn, cur)
         logging.debug("mulligan: %s, challenger: %s", m, c.id)
+        if m is None:
+            # that mulligan's checkin is already there
+            return
         cur.execute(
             "update challenger_challenges set mulligan = %s where challenger_id = %s and challenge_id = %s",
             [m, c.id, challenge_week.challenge_id],
         )
+        notify_change(
+            cur,
+            "challenger_challenges",
+            challenge_id=challenge_week.challenge_id,
+            challenger_id=c.id,
+        )
 
     with_psycopg(insert_checkin_and_associate_mulligan)
     return render_template("mulligan.html", challenger=c)
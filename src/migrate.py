@@ -0,0 +1,79 @@
+from helpers import connection_string
+from scores import rebuild_scores
+from pathlib import Path
+from psycopg.rows import namedtuple_row
+import psycopg
+import sys
+import logging
+
+MIGRATIONS = Path(__file__).parent / "sql" / "migrations"
+# Held while migrating so two containers starting together take turns
+LOCK_KEY = 7262001
+# Migrations that change what challenger_week_scores is built from. When any
+# of them applies, every challenge's scores are rebuilt along with the last
+# pending migration, so a failed rebuild leaves it pending to try again.
+REBUILDS_SCORES = {"0003", "0006", "0007"}
+
+
+def migrations():
+    """(version, path) of every migration file, in the order they apply.
+    Files are named NNNN_description.sql."""
+    return [(path.name.split("_", 1)[0], path) for path in sorted(MIGRATIONS.glob("*.sql"))]
+
+
+def applied(conn):
+    conn.execute(
+        """
+        create table if not exists schema_migrations (
+          version text primary key,
+          name text not null,
+          applied_at timestamptz not null default now()
+        )
+        """
+    )
+    return {row[0] for row in conn.execute("select version from schema_migrations")}
+
+
+def rebuild_all_scores(conn):
+    with conn.cursor() as cur:
+        cur.execute("select id from challenges order by id")
+        for (challenge_id,) in cur.fetchall():
+            written = rebuild_scores(cur, challenge_id)
+            logging.info("rebuilt %s week scores for challenge %s", written, challenge_id)
+
+
+def migrate(conninfo=connection_string, dry_run=False):
+    """Applies the migrations the database hasn't seen yet, each in its own
+    transaction, and returns their file names"""
+    with psycopg.connect(conninfo, autocommit=True, row_factory=namedtuple_row) as conn:
+        conn.execute("select pg_advisory_lock(%s)", [LOCK_KEY])
+        try:
+            done = applied(conn)
+            pending = [(v, path) for v, path in migrations() if v not in done]
+            rebuild = any(v in REBUILDS_SCORES for v, _ in pending)
+            for version, path in pending:
+                if dry_run:
+                    continue
+                logging.info("applying migration %s", path.name)
+                with conn.transaction():
+                    conn.execute(path.read_text())
+                    conn.execute(
+                        "insert into schema_migrations (version, name) values (%s, %s)",
+                        [version, path.name],
+                    )
+                    if rebuild and version == pending[-1][0]:
+                        rebuild_all_scores(conn)
+            return [path.name for _, path in pending]
+        finally:
+            conn.execute("select pg_advisory_unlock(%s)", [LOCK_KEY])
+
+
+if __name__ == "__main__":
+    # python migrate.py [--dry-run]
+    logging.basicConfig(level="INFO")
+    dry_run = "--dry-run" in sys.argv[1:]
+    names = migrate(dry_run=dry_run)
+    for name in names:
+        print(("pending " if dry_run else "applied ") + name)
+    if not names:
+        print("up to date")
@@ -1,5 +1,7 @@
 from helpers import fetchall, with_psycopg
 from base_queries import insert_checkin
+from notifications import notify_change
+from challenge_calendar import get_calendar
 import datetime
 import logging
 import pytz
@@ -35,30 +37,27 @@ def find_date(week, day):
 
 
 def last_week_mulligan_table():
-    last_week_id_sql = """
-    select id from challenge_weeks 
-    where 
-        week_of_year = extract(week from current_timestamp - INTERVAL '1 day') and
-        extract(year from start) = extract(year from current_date)
-    """
-    sql = (
-        """
-    select 
-        c.name,
-        count(*),
+    now = datetime.datetime.now(pytz.timezone("America/New_York"))
+    yesterday = now - datetime.timedelta(days=1)
+    last_week = get_calendar().week_at(yesterday)
+    if last_week is None:
+        return []
+    sql = """
+    select
+        ch.name,
+        (select count(*) from unnest(s.best_tiers) tier where tier > 0) as count,
         cw.green,
         cw.id as cwid
-    from checkins c 
-    join challenge_weeks cw ON cw.id = c.challenge_week_id
-    where 
-        c.challenge_week_id = (%s) 
-        and tier != 'T0'
-    group by c.name, cw.green, cwid;
+    from challenger_week_scores s
+    join challenge_weeks cw ON cw.id = s.challenge_week_id
+    join challengers ch ON ch.id = s.challenger_id
+    where
+        s.challenge_week_id = %s
+        -- any day above T0, which can score nothing under rule set 1
+        and 0 < any(s.best_tiers);
     """
-        % last_week_id_sql
-    )
 
-    return fetchall(sql)
+    return fetchall(sql, [last_week.id])
 
 
 def check_last_week_for_mulligan_necessity():
@@ -125,9 +124,18 @@ def insert_mulligan_for(name, challenge_week_id):
             time,
         )(conn, cur)
         logging.debug("mulligan: %s, challenger: %s", m, challenger.id)
+        if m is None:
+            # that mulligan's checkin is already there
+            return
         cur.execute(
             "update challenger_challenges set mulligan = %s where challenger_id = %s and challenge_id = %s",
             [m, challenger.id, challenge_week.challenge_id],
         )
+        notify_change(
+            cur,
+            "challenger_challenges",
+            challenge_id=challenge_week.challenge_id,
+            challenger_id=challenger.id,
+        )
 
     with_psycopg(insert_checkin_and_associate_mulligan)
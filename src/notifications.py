@@ -0,0 +1,210 @@
+import psycopg
+from psycopg import sql
+from helpers import connection_string
+from typing import NamedTuple, Optional
+import threading
+import json
+import time
+import os
+import logging
+
+CHANNEL = "checkin_viz_changes"
+
+# Set while this process has a live LISTEN connection. Caches use it to decide
+# whether they can rely on notifications or have to fall back to a short TTL.
+listening = threading.Event()
+
+_handlers = []
+_thread = None
+_thread_lock = threading.Lock()
+
+
+class Change(NamedTuple):
+    table: str
+    challenge_id: Optional[int]
+    challenge_week_id: Optional[int]
+    challenger_id: Optional[int]
+
+
+def subscribe(handler):
+    """Registers handler(change) to run in the listener thread for every change.
+
+    change is None after the listener (re)connects, since anything could have
+    been written while nobody was listening.
+    """
+    _handlers.append(handler)
+    return handler
+
+
+def notify_change(cur, table, challenge_id=None, challenge_week_id=None, challenger_id=None):
+    """Queues a change notification on cur's transaction. Postgres only delivers
+    it once the transaction commits, so listeners never see uncommitted data."""
+    cur.execute(
+        """
+        select pg_notify(%s, json_build_object(
+            'table', %s::text,
+            'challenge_id', coalesce(
+                %s::int,
+                (select challenge_id from challenge_weeks where id = %s::int)
+            ),
+            'challenge_week_id', %s::int,
+            'challenger_id', %s::int
+        )::text)
+        """,
+        [
+            CHANNEL,
+            table,
+            challenge_id,
+            challenge_week_id,
+            challenge_week_id,
+            challenger_id,
+        ],
+    )
+
+
+def _dispatch(change):
+    for handler in _handlers:
+        try:
+            handler(change)
+        except Exception:
+            logging.exception("change handler %s failed", handler)
+
+
+def _parse(payload):
+    try:
+        return Change(**json.loads(payload))
+    except (ValueError, TypeError):
+        logging.error("ignoring malformed change %r", payload)
+        return None
+
+
+def _listen():
+    backoff = 1
+    while True:
+        try:
+            with psycopg.connect(
+                connection_string,
+                autocommit=True,
+                application_name="checkin-viz listener %s" % os.getpid(),
+            ) as conn:
+                conn.execute(sql.SQL("LISTEN {}").format(sql.Identifier(CHANNEL)))
+                listening.set()
+                backoff = 1
+                logging.info("listening for changes on %s", CHANNEL)
+                _dispatch(None)
+                while True:
+                    for notify in conn.notifies(timeout=30):
+                        logging.debug("change: %s", notify.payload)
+                        change = _parse(notify.payload)
+                        if change is not None:
+                            _dispatch(change)
+                    # notifies() can't tell a quiet channel from a dead socket
+                    conn.execute("select 1")
+        except psycopg.Error:
+            logging.exception("change listener disconnected")
+        finally:
+            # also when something unexpected kills the thread, so caches fall
+            # back to their short TTLs until start_listener starts another
+            listening.clear()
+        time.sleep(backoff)
+        backoff = min(backoff * 2, 60)
+
+
+def start_listener():
+    """Starts this process's listener thread if it isn't already running"""
+    global _thread
+    if os.environ.get("CHANGE_LISTENER_DISABLED") is not None:
+        return
+    with _thread_lock:
+        if _thread is None or not _thread.is_alive():
+            _thread = threading.Thread(
+                target=_listen, name="change-listener", daemon=True
+            )
+            _thread.start()
+
+
+if __name__ == "__main__":
+    # python notifications.py checks change notifications against the
+    # Postgres in DB_CONNECT_STRING, through the render cache: a committed
+    # change drops only its challenge's pages, a rolled back one drops
+    # nothing, and while the listener is down pages fall back to the short
+    # TTL until it reconnects. Nothing is written to the database.
+    # run as a script this file is __main__, a separate module from the
+    # notifications the render cache subscribed through
+    import notifications
+    from cache_decorator import render_cache
+
+    def wait_for(condition, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def fill():
+        render_cache.clear()
+        for challenge_id in [1, 2, None]:
+            render_cache.put(("page", challenge_id), "<html/>", challenge_id)
+
+    def cached():
+        return {c for c in [1, 2, None] if render_cache.get(("page", c)) is not None}
+
+    def change(commit=True, **kwargs):
+        with psycopg.connect(connection_string) as conn:
+            notify_change(conn.cursor(), "checkins", **kwargs)
+            if not commit:
+                conn.rollback()
+
+    seen = []
+    notifications.subscribe(seen.append)
+    notifications.start_listener()
+    assert wait_for(notifications.listening.is_set), "listener never connected"
+
+    fill()
+    change(challenge_id=1)
+    assert wait_for(lambda: 1 not in cached()), "change to challenge 1 not heard"
+    assert cached() == {2, None}, cached()
+    assert seen[-1] == Change("checkins", 1, None, None), seen[-1]
+
+    fill()
+    change(commit=False, challenge_id=2)
+    change(challenge_id=1)
+    assert wait_for(lambda: 1 not in cached())
+    assert cached() == {2, None}, "rolled back change was delivered"
+
+    fill()
+    change(challenger_id=1)
+    assert wait_for(lambda: not cached()), "change without a challenge kept pages"
+
+    # malformed payloads are skipped without taking the listener down
+    fill()
+    with psycopg.connect(connection_string) as conn:
+        for payload in ["not json", '{"table": "checkins"}', "[]"]:
+            conn.execute("select pg_notify(%s, %s)", [CHANNEL, payload])
+    change(challenge_id=1)
+    assert wait_for(lambda: 1 not in cached()), "listener died on a bad payload"
+    assert cached() == {2, None} and notifications.listening.is_set()
+
+    # pages outlive the short TTL while listening, not once the listener drops
+    render_cache.ttl = 0.5
+    fill()
+    time.sleep(0.6)
+    assert cached() == {1, 2, None}
+    with psycopg.connect(connection_string, autocommit=True) as conn:
+        conn.execute(
+            "select pg_terminate_backend(pid) from pg_stat_activity "
+            "where application_name = %s",
+            ["checkin-viz listener %s" % os.getpid()],
+        )
+    assert wait_for(lambda: not notifications.listening.is_set()), "listener never noticed"
+    assert render_cache.get(("page", 1)) is None
+    fill()
+    time.sleep(0.6)
+    assert render_cache.get(("page", 2)) is None
+
+    # reconnecting drops everything, anything could have changed meanwhile
+    fill()
+    assert wait_for(notifications.listening.is_set), "listener never reconnected"
+    assert wait_for(lambda: not cached()) and seen[-1] is None
+    print("notifications ok")
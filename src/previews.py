@@ -0,0 +1,131 @@
+from concurrent.futures import ThreadPoolExecutor
+from rasterizer import rasterizer
+import hashlib
+import tempfile
+import threading
+import time
+import os
+import logging
+
+PREVIEW_DIR = os.environ.get(
+    "PREVIEW_DIR", os.path.join(os.path.dirname(__file__), "static", "previews")
+)
+PREVIEW_MAX_BYTES = int(os.environ.get("PREVIEW_MAX_BYTES", 50 * 1024 * 1024))
+# A week's superseded previews, and temporary files left by a worker that
+# died mid render, are kept this long. Workers still holding an older chart
+# (for up to the render cache's TTL) go on asking for their own file, so
+# deleting it straight away would have them re-rendering each other's.
+PREVIEW_KEEP_SECONDS = float(os.environ.get("PREVIEW_KEEP_SECONDS", 3600))
+
+# One thread per worker hands previews to the rasterizer: they're best effort
+# and shouldn't take more than one of its slots.
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="preview")
+_pending = set()
+_pending_lock = threading.Lock()
+
+
+def preview_filename(week_id, svg):
+    digest = hashlib.sha1(svg.encode("utf-8")).hexdigest()[:16]
+    return "preview-{week}-{digest}.png".format(week=week_id, digest=digest)
+
+
+def request_preview(week_id, svg):
+    """Queues the PNG preview for this chart to be rendered in the background
+    if no worker has rendered it yet, so /preview/<week_id>.png can usually
+    serve it from disk.
+
+    Files are named by a hash of the SVG so unchanged charts are never
+    re-rendered and every worker agrees on the name without coordinating.
+    """
+    filename = preview_filename(week_id, svg)
+    if not os.path.exists(os.path.join(PREVIEW_DIR, filename)):
+        with _pending_lock:
+            if filename not in _pending:
+                _pending.add(filename)
+                _executor.submit(_render, week_id, svg, filename)
+
+
+def preview_png(week_id, svg):
+    """Returns the PNG preview for this chart, rendering it now if no worker
+    has yet. Raises the rasterizer's errors when it's busy or too slow."""
+    filename = preview_filename(week_id, svg)
+    try:
+        with open(os.path.join(PREVIEW_DIR, filename), "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+    png = rasterizer.rasterize(svg)
+
+    def save(path):
+        with open(path, "wb") as f:
+            f.write(png)
+
+    try:
+        _publish(week_id, filename, save)
+    except OSError:
+        logging.exception("Failed to save og image for week %s", week_id)
+    return png
+
+
+def _render(week_id, svg, filename):
+    try:
+        _publish(
+            week_id, filename, lambda path: rasterizer.rasterize(svg, write_to=path)
+        )
+    except Exception:
+        logging.exception("Failed to write og image for week %s", week_id)
+    finally:
+        with _pending_lock:
+            _pending.discard(filename)
+
+
+def _publish(week_id, filename, write):
+    """Calls write(path) to fill a temporary file, then moves it into place"""
+    os.makedirs(PREVIEW_DIR, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=PREVIEW_DIR, prefix=".", suffix=".png")
+    os.close(fd)
+    try:
+        write(tmp)
+        # mkstemp makes the file 0600; other users (a static server) need to read it
+        os.chmod(tmp, 0o644)
+        # rename is atomic so nobody ever serves a half written file
+        os.replace(tmp, os.path.join(PREVIEW_DIR, filename))
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    cleanup_previews(week_id, filename)
+
+
+def cleanup_previews(week_id, keep, now=None):
+    """Deletes the week's superseded previews and abandoned temporary files
+    once they're PREVIEW_KEEP_SECONDS old, then the oldest previews of any
+    week until the directory fits in PREVIEW_MAX_BYTES."""
+    stale = (now or time.time()) - PREVIEW_KEEP_SECONDS
+    week_prefix = "preview-{week}-".format(week=week_id)
+    previews = []
+    for entry in os.scandir(PREVIEW_DIR):
+        if not entry.name.endswith(".png") or entry.name == keep:
+            continue
+        try:
+            stat = entry.stat()
+            if entry.name.startswith((week_prefix, ".")):
+                if stat.st_mtime < stale:
+                    os.remove(entry.path)
+            elif entry.name.startswith("preview-"):
+                previews.append((stat.st_mtime, stat.st_size, entry.path))
+        except FileNotFoundError:
+            # another worker got there first
+            pass
+
+    total = sum(size for _, size, _ in previews)
+    for _, size, path in sorted(previews):
+        if total <= PREVIEW_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
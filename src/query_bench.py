@@ -0,0 +1,242 @@
+from helpers import Query, connection_string
+from base_queries import (
+    challenge_details,
+    challenge_validators,
+    checkins_this_week,
+    points_so_far,
+    week_view,
+)
+from rule_sets import calculate_total_score, calculate_total_score_from_checkins
+from season import season_checkins
+from challenge_calendar import get_calendar
+from scores import DAY_TIERS, rebuild
+from migrate import migrate
+from datetime import date, datetime, time, timedelta
+import argparse
+import statistics
+import random
+import json
+import sys
+import psycopg
+import pytz
+import logging
+
+
+def hot_queries(challenge_id, week_id, challenger_id):
+    """The queries behind page views and checkins, as the app builds them"""
+    calendar = get_calendar()
+    return {
+        "week_view": week_view.query(week_id),
+        "checkins_this_week": checkins_this_week.query(week_id),
+        "challenge_validators": challenge_validators.query(challenge_id, week_id),
+        "latest_checkin": Query(
+            "select time from checkins order by time desc limit 1", [], True, None
+        ),
+        "calculate_total_score": calculate_total_score.query(challenge_id),
+        "calculate_total_score_from_checkins": calculate_total_score_from_checkins.query(
+            challenge_id
+        ),
+        "points_so_far": points_so_far.query(challenge_id),
+        "get_challenge_score": Query(
+            "select * from get_challenge_score(%s, false)", (challenge_id,), False, None
+        ),
+        "challenge_details": challenge_details.query(challenge_id),
+        "season_checkins": season_checkins.query(
+            challenge_id,
+            calendar.challenges_by_id[challenge_id].start,
+            [w.id for w in calendar.weeks_of(challenge_id)],
+        ),
+        "refresh_week_score": Query(
+            DAY_TIERS.format(where="c.challenger = %s and c.challenge_week_id = %s"),
+            (challenger_id, week_id),
+            False,
+            None,
+        ),
+    }
+
+
+def load(conn, challengers, weeks, seed=0):
+    """Fills an empty database with one challenge of weeks weeks, ending this
+    week, and challengers checking in most days. Returns the challenge id."""
+    if conn.execute("select exists (select 1 from checkins)").fetchone()[0]:
+        raise SystemExit("refusing to load synthetic data into a database with checkins")
+    rng = random.Random(seed)
+    zone = pytz.timezone("America/New_York")
+    today = date.today()
+    start = today - timedelta(days=today.weekday() + 7 * (weeks - 1))
+    with conn.transaction():
+        challenge_id = conn.execute(
+            'insert into challenges (name, start, "end", bi_weeks, rule_set) '
+            "values (%s, %s, %s, 0, 2) returning id",
+            ["Bench %s" % start, start, start + timedelta(days=7 * weeks - 1)],
+        ).fetchone()[0]
+        week_ids = [
+            conn.execute(
+                'insert into challenge_weeks (challenge_id, week_of_year, start, "end", green, bye_week) '
+                "values (%s, %s, %s, %s, %s, false) returning id",
+                [
+                    challenge_id,
+                    (start + timedelta(days=7 * w)).isocalendar()[1],
+                    start + timedelta(days=7 * w),
+                    start + timedelta(days=7 * w + 6),
+                    w % 4 == 0,
+                ],
+            ).fetchone()[0]
+            for w in range(weeks)
+        ]
+        challenger_ids = []
+        for n in range(challengers):
+            name = "bench%04d" % n
+            challenger_id = conn.execute(
+                "insert into challengers (name, phone_number, email_domain, bmr) "
+                "values (%s, %s, 'example.com', 2000) returning id",
+                [name, "555%07d" % n],
+            ).fetchone()[0]
+            conn.execute(
+                "insert into challenger_challenges (challenge_id, challenger_id, ante, tier) "
+                "values (%s, %s, 100, %s)",
+                [challenge_id, challenger_id, rng.choice(["T2", "T3", "floating"])],
+            )
+            challenger_ids.append((challenger_id, name))
+        with conn.cursor().copy(
+            "copy checkins (name, time, tier, day_of_week, text, challenge_week_id, challenger, tz) from stdin"
+        ) as copy:
+            for day in range((today - start).days + 1):
+                local_day = start + timedelta(days=day)
+                week_id = week_ids[day // 7]
+                for challenger_id, name in challenger_ids:
+                    if rng.random() > 0.7:
+                        continue
+                    minutes = rng.sample(range(5 * 60, 22 * 60), rng.choice([1, 1, 2]))
+                    for minute in minutes:
+                        tier = "T%s" % rng.choice([0, 1, 2, 2, 3, 3, 4, 5])
+                        copy.write_row(
+                            (
+                                name,
+                                zone.localize(
+                                    datetime.combine(local_day, time(minute // 60, minute % 60))
+                                ),
+                                tier,
+                                local_day.strftime("%A"),
+                                "%s checkin" % tier,
+                                week_id,
+                                challenger_id,
+                                "America/New_York",
+                            )
+                        )
+    rebuild(challenge_id)
+    # as autovacuum would have by now, so index only scans are possible
+    conn.execute("vacuum analyze")
+    return challenge_id
+
+
+def pick_ids(conn, challenge_id=None):
+    """The latest challenge (or challenge_id), its latest week with checkins
+    and that week's busiest challenger"""
+    if challenge_id is None:
+        challenge_id = conn.execute(
+            'select id from challenges order by start desc, "end" desc limit 1'
+        ).fetchone()[0]
+    week_id, challenger_id = conn.execute(
+        """
+        select c.challenge_week_id, c.challenger
+        from checkins c
+        join challenge_weeks cw on cw.id = c.challenge_week_id
+        where cw.challenge_id = %s
+        group by c.challenge_week_id, cw.start, c.challenger
+        order by cw.start desc, count(*) desc
+        limit 1
+        """,
+        [challenge_id],
+    ).fetchone()
+    return challenge_id, week_id, challenger_id
+
+
+def index_names(plan):
+    names = {plan["Index Name"]} if "Index Name" in plan else set()
+    for child in plan.get("Plans", []):
+        names |= index_names(child)
+    return names
+
+
+def explain(conn, q, runs):
+    """Runs EXPLAIN (ANALYZE, BUFFERS) on q runs times, returning the median
+    timings and the buffers and indexes of the last run"""
+    executions, plannings = [], []
+    for _ in range(runs):
+        (result,) = conn.execute(
+            "explain (analyze, buffers, format json) " + q.sql, q.args
+        ).fetchone()
+        executions.append(result[0]["Execution Time"])
+        plannings.append(result[0]["Planning Time"])
+    plan = result[0]["Plan"]
+    return {
+        "execution_ms": round(statistics.median(executions), 3),
+        "planning_ms": round(statistics.median(plannings), 3),
+        "shared_hit": plan.get("Shared Hit Blocks", 0),
+        "shared_read": plan.get("Shared Read Blocks", 0),
+        "node": plan["Node Type"],
+        "indexes": sorted(index_names(plan)),
+    }
+
+
+def compare(results, baseline, threshold):
+    """Names of queries more than threshold (a fraction) slower than baseline"""
+    return [
+        name
+        for name, result in results.items()
+        if name in baseline
+        and result["execution_ms"]
+        > baseline[name]["execution_ms"] * (1 + threshold) + 0.05
+    ]
+
+
+if __name__ == "__main__":
+    # python query_bench.py --load                 # into an empty database
+    # python query_bench.py --save before.json
+    # python query_bench.py --compare before.json  # exits 1 on a regression
+    parser = argparse.ArgumentParser(description="EXPLAIN ANALYZE the hot queries")
+    parser.add_argument("--load", action="store_true", help="load synthetic data first")
+    parser.add_argument("--challengers", type=int, default=300)
+    parser.add_argument("--weeks", type=int, default=52)
+    parser.add_argument("--challenge", type=int)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--save", help="write the results as JSON here")
+    parser.add_argument("--compare", help="JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    challenge_id = args.challenge
+    with psycopg.connect(connection_string, autocommit=True) as conn:
+        if args.load:
+            migrate()
+            challenge_id = load(conn, args.challengers, args.weeks)
+        ids = pick_ids(conn, challenge_id)
+        results = {
+            name: explain(conn, q, args.runs) for name, q in hot_queries(*ids).items()
+        }
+
+    baseline = json.load(open(args.compare)) if args.compare else {}
+    print("challenge %s, week %s, challenger %s" % ids)
+    print("%-36s %10s %10s %8s %8s  %s" % ("query", "exec ms", "base ms", "hit", "read", "indexes"))
+    for name, result in results.items():
+        base = baseline.get(name, {}).get("execution_ms")
+        print(
+            "%-36s %10.3f %10s %8s %8s  %s"
+            % (
+                name,
+                result["execution_ms"],
+                "-" if base is None else "%.3f" % base,
+                result["shared_hit"],
+                result["shared_read"],
+                ", ".join(result["indexes"]) or result["node"],
+            )
+        )
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    slower = compare(results, baseline, args.threshold)
+    if slower:
+        print("slower than %s: %s" % (args.compare, ", ".join(slower)))
+        sys.exit(1)
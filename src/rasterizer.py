@@ -0,0 +1,157 @@
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import threading
+import time
+import sys
+import os
+import logging
+
+# Per gunicorn worker, and the Pi runs four of them
+RASTER_POOL_SIZE = int(os.environ.get("RASTER_POOL_SIZE", 1))
+# Jobs running or waiting for a process; submitting more raises RasterizerBusy
+RASTER_MAX_QUEUE = int(os.environ.get("RASTER_MAX_QUEUE", 8))
+RASTER_TIMEOUT = float(os.environ.get("RASTER_TIMEOUT", 30))
+
+
+class RasterizerBusy(Exception):
+    pass
+
+
+class RasterizerTimeout(Exception):
+    pass
+
+
+def _svg2png(svg, write_to):
+    # Runs in the pool's processes, which are the only ones that load cairo
+    import cairosvg
+
+    return cairosvg.svg2png(bytestring=svg, write_to=write_to)
+
+
+class Rasterizer:
+    """A bounded pool of processes converting SVGs to PNGs.
+
+    cairosvg holds the GIL for most of a conversion, so doing it in a worker
+    blocks every other request that worker could have served. Processes are
+    spawned rather than forked since the web workers run threads (the change
+    listener, the connection pool) that don't survive a fork.
+    """
+
+    def __init__(self, size, max_queue, timeout):
+        self.size = size
+        self.timeout = timeout
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self._slots = threading.BoundedSemaphore(max_queue)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.size,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._executor
+
+    def rasterize(self, svg, write_to=None, timeout=None):
+        """Returns the PNG for svg, or writes it to the path write_to.
+
+        Raises RasterizerBusy straight away when max_queue jobs are already
+        in flight and RasterizerTimeout when the job takes longer than
+        timeout (default RASTER_TIMEOUT) seconds.
+        """
+        if isinstance(svg, str):
+            svg = svg.encode("utf-8")
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise RasterizerBusy()
+        try:
+            executor = self._pool()
+            future = executor.submit(_svg2png, svg, write_to)
+            try:
+                png = future.result(timeout=timeout or self.timeout)
+            except TimeoutError:
+                self.timeouts += 1
+                self._restart(executor)
+                raise RasterizerTimeout()
+            except BrokenProcessPool:
+                # a process died (OOM killer, crash in cairo): start over
+                self.failed += 1
+                self._restart(executor)
+                raise
+            except Exception:
+                self.failed += 1
+                raise
+            self.completed += 1
+            return png
+        finally:
+            self._slots.release()
+
+    def _restart(self, executor):
+        """Replaces a stuck or broken pool with a fresh one. Jobs still queued
+        in the old pool are cancelled; a running one can't be, so its process
+        exits once the job finishes."""
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+        logging.warning("restarting the rasterizer pool")
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+        }
+
+
+rasterizer = Rasterizer(RASTER_POOL_SIZE, RASTER_MAX_QUEUE, RASTER_TIMEOUT)
+
+
+def benchmark(svg, concurrency, jobs):
+    """Rasterizes svg jobs times from concurrency threads, returning PNGs/s"""
+    pool = Rasterizer(concurrency, concurrency, RASTER_TIMEOUT)
+    pool.rasterize(svg)  # start the processes
+    jobs_left = iter(range(jobs))
+    lock = threading.Lock()
+
+    def run():
+        while True:
+            with lock:
+                if next(jobs_left, None) is None:
+                    return
+            pool.rasterize(svg)
+
+    threads = [threading.Thread(target=run) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    pool.shutdown()
+    return jobs / elapsed
+
+
+if __name__ == "__main__":
+    # python rasterizer.py chart.svg [jobs]
+    with open(sys.argv[1], "rb") as f:
+        svg = f.read()
+    jobs = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    for concurrency in (1, 4, 8):
+        rate = benchmark(svg, concurrency, jobs)
+        print("%s concurrent: %.1f PNGs/s" % (concurrency, rate))
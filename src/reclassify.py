@@ -0,0 +1,155 @@
+from classify import classify_many
+from helpers import connection_string, with_psycopg
+from notifications import notify_change
+from scores import challenge_ids, refresh_week_score
+from psycopg.rows import namedtuple_row
+from typing import NamedTuple, Optional
+import argparse
+import psycopg
+import sys
+import logging
+
+# Checkins read, classified and corrected at a time
+CHUNK_SIZE = 5000
+
+CHECKINS = """
+    select c.id, c.text, c.tier, c.challenger, c.challenge_week_id
+    from checkins c
+    join challenge_weeks cw on cw.id = c.challenge_week_id
+    where cw.challenge_id = %s and c.text is not null
+    order by c.id
+"""
+
+
+class Difference(NamedTuple):
+    # as CHECKINS selects them
+    id: int
+    text: str
+    tier: str
+    challenger: int
+    challenge_week_id: int
+    # None when the text no longer classifies as a checkin
+    new_tier: Optional[str]
+    reason: str
+
+    def __str__(self):
+        return "checkin %s (challenger %s, week %s): %s -> %s, %s: %r" % (
+            self.id,
+            self.challenger,
+            self.challenge_week_id,
+            self.tier,
+            self.new_tier or "-",
+            self.reason,
+            self.text[:60],
+        )
+
+
+def differences(rows):
+    """The rows whose stored tier classify disagrees with. Checkins whose
+    text names no tier keep the one they have."""
+    for row, (is_checkin, tier, reason) in zip(
+        rows, classify_many(row.text for row in rows)
+    ):
+        if not is_checkin:
+            yield Difference(*row, None, reason)
+        elif tier is not None and tier != row.tier:
+            yield Difference(*row, tier, reason)
+
+
+def correct(challenge_id, found, delete):
+    """Applies one chunk's differences in one transaction and refreshes the
+    weekly scores they touch. Rows changed since they were read are left
+    alone. Returns (updated, deleted)."""
+    retier = [d for d in found if d.new_tier is not None]
+    remove = [d for d in found if d.new_tier is None] if delete else []
+
+    def fn(conn, cur):
+        cur.execute(
+            """
+            update checkins c set tier = v.tier
+            from unnest(%s::int[], %s::text[], %s::text[]) as v(id, tier, old)
+            where c.id = v.id and c.tier = v.old
+            returning c.challenger, c.challenge_week_id
+            """,
+            [
+                [d.id for d in retier],
+                [d.new_tier for d in retier],
+                [d.tier for d in retier],
+            ],
+        )
+        changed = cur.fetchall()
+        updated = len(changed)
+        cur.execute(
+            """
+            delete from checkins c
+            using unnest(%s::int[], %s::text[]) as v(id, old)
+            where c.id = v.id and c.tier = v.old
+            returning c.challenger, c.challenge_week_id
+            """,
+            [[d.id for d in remove], [d.tier for d in remove]],
+        )
+        changed += cur.fetchall()
+        # in a fixed order so two runs can't deadlock on the week locks
+        for challenger, week_id in sorted(set(changed)):
+            refresh_week_score(cur, challenger, week_id)
+        if changed:
+            notify_change(cur, "checkins", challenge_id=challenge_id)
+        return updated, len(changed) - updated
+
+    return with_psycopg(fn)
+
+
+def reclassify(challenge_id, dry_run=False, delete=False, chunk_size=CHUNK_SIZE, report=logging.info):
+    """Runs a challenge's stored checkin text back through classify,
+    reporting each difference and, unless dry_run, correcting tiers (and with
+    delete, removing checkins that are no longer checkins).
+
+    Checkins are streamed through a server side cursor chunk_size at a time,
+    each chunk corrected in its own transaction, so memory doesn't grow with
+    the challenge. Returns counts of what was checked and changed."""
+    counts = {"checked": 0, "differences": 0, "updated": 0, "deleted": 0}
+    with psycopg.connect(connection_string, row_factory=namedtuple_row) as conn:
+        with conn.cursor(name="reclassify_checkins") as cur:
+            cur.itersize = chunk_size
+            cur.execute(CHECKINS, [challenge_id])
+            while rows := cur.fetchmany(chunk_size):
+                found = list(differences(rows))
+                for difference in found:
+                    report(difference)
+                counts["checked"] += len(rows)
+                counts["differences"] += len(found)
+                if found and not dry_run:
+                    updated, deleted = correct(challenge_id, found, delete)
+                    counts["updated"] += updated
+                    counts["deleted"] += deleted
+    logging.info("reclassified challenge %s: %s", challenge_id, counts)
+    return counts
+
+
+if __name__ == "__main__":
+    # python reclassify.py <challenge_id>... | --all [--dry-run] [--delete]
+    parser = argparse.ArgumentParser(
+        description="Reclassify stored checkin text and correct tiers"
+    )
+    parser.add_argument("challenge_id", type=int, nargs="*")
+    parser.add_argument("--all", action="store_true", help="every challenge")
+    parser.add_argument("--dry-run", action="store_true", help="only report differences")
+    parser.add_argument(
+        "--delete", action="store_true", help="delete checkins that aren't checkins any more"
+    )
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    for challenge_id in challenge_ids(args):
+        counts = reclassify(
+            challenge_id,
+            dry_run=args.dry_run,
+            delete=args.delete,
+            chunk_size=args.chunk_size,
+            report=lambda difference: print("challenge %s: %s" % (challenge_id, difference)),
+        )
+        print(
+            "challenge %s: %s checked, %s differences, %s updated, %s deleted"
+            % (challenge_id, *counts.values())
+        )
+    sys.exit(0)
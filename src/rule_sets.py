@@ -1,19 +1,24 @@
-import itertools
+from typing import NamedTuple
+import numpy as np
+import random
+import time
 import os
 import logging
-from helpers import fetchall
+from helpers import query
 
 LOGLEVEL = os.environ.get("LOGLEVEL", "WARNING").upper()
 logging.basicConfig(level="INFO")
 
-
-def score(tier, rule_set):
-    if rule_set == 1:
-        return version_1_score(tier)
-    return version_2_score(tier)
+# Highest tier the built in rule sets are compiled into a table for; higher
+# tiers are scored by their functions.
+MAX_TIER = 10
+# How often the rule_sets table is read again for an id it didn't have
+RULE_SETS_RELOAD = float(os.environ.get("RULE_SETS_RELOAD", 60))
 
 
 def version_1_score(tier):
+    # Only tier names match; tier numbers, which totals, stored scores and the
+    # season page pass, score 1 whatever the tier
     match tier:
         case "T0":
             return 0
@@ -33,13 +38,187 @@ def version_2_score(tier):
         return 0
     number = int(tier.lstrip("T")) if isinstance(tier, str) else tier
     points = 0.9 + 0.1 * number
-    logging.info("Tier: %s Number: %s Points: %s", tier, number, points)
+    logging.debug("Tier: %s Number: %s Points: %s", tier, number, points)
     return points
 
 
+class RuleSet:
+    """A rule set compiled into tier number -> points lookup tables.
+
+    points is what tier numbers score and named_points, when it's given,
+    what tier names ("T3") score; they only differ for version 1. T0, and
+    anything below it such as the -1 used for days without a checkin, always
+    scores nothing. Tiers past the table are scored by score_tier, or as the
+    last tier in it.
+    """
+
+    def __init__(self, id, name, points, score_tier=None, named_points=None):
+        self.id = id
+        self.name = name
+        self.score_tier = score_tier
+        self.points = np.array([0.0, *points[1:]], dtype=float)
+        self.points.flags.writeable = False
+        self._points = self.points.tolist()
+        self._named_points = [0.0, *map(float, (named_points or self._points)[1:])]
+        self._by_tier = {
+            **dict(enumerate(self._points)),
+            **{"T%s" % n: p for n, p in enumerate(self._named_points)},
+        }
+
+    def score(self, tier):
+        """Points for one tier, given as "T3" or 3"""
+        points = self._by_tier.get(tier)
+        if points is not None:
+            return points
+        named = isinstance(tier, str)
+        number = int(tier.lstrip("T")) if named else int(tier)
+        if number <= 0:
+            return 0.0
+        table = self._named_points if named else self._points
+        if number < len(table):
+            return table[number]
+        if self.score_tier is not None:
+            return float(self.score_tier("T%s" % number if named else number))
+        return table[-1]
+
+    def scores(self, tiers):
+        """Points for an array of tier numbers"""
+        tiers = np.asarray(tiers)
+        points = np.where(
+            tiers > 0, self.points[np.clip(tiers, 0, len(self.points) - 1)], 0.0
+        )
+        beyond = tiers >= len(self.points)
+        if self.score_tier is not None and beyond.any():
+            points[beyond] = [self.score(int(tier)) for tier in tiers[beyond]]
+        return points
+
+    def week_points(self, tiers):
+        """A week's points: the best five of its days' tiers"""
+        points = list(map(self._by_tier.get, tiers))
+        if None in points:
+            points = list(map(self.score, tiers))
+        return round(sum(sorted(points, reverse=True)[:5]), 4)
+
+    def __repr__(self):
+        return "RuleSet(%s, %r)" % (self.id, self.name)
+
+
+def compile_rule_set(id, name, score_tier):
+    return RuleSet(
+        id,
+        name,
+        [score_tier(n) for n in range(MAX_TIER + 1)],
+        score_tier,
+        [score_tier("T%s" % n) for n in range(MAX_TIER + 1)],
+    )
+
+
+BUILT_IN = {
+    1: compile_rule_set(1, "version 1", version_1_score),
+    2: compile_rule_set(2, "version 2", version_2_score),
+}
+
+# Rule sets from the rule_sets table, loaded the first time one is asked for.
+# They're never edited once a challenge uses them; add a new one instead.
+_stored = {}
+_loaded_at = None
+
+
+@query()
+def stored_rule_sets():
+    return "select id, name, tier_points from rule_sets", []
+
+
+def get_rule_set(rule_set):
+    """The compiled rule set for a challenges.rule_set id. Unknown ids score as
+    version 2, as they always have, until a rule_sets row for them turns up."""
+    global _loaded_at
+    if isinstance(rule_set, RuleSet):
+        return rule_set
+    compiled = BUILT_IN.get(rule_set) or _stored.get(rule_set)
+    if compiled is not None:
+        return compiled
+    now = time.monotonic()
+    if _loaded_at is None or now - _loaded_at > RULE_SETS_RELOAD:
+        _loaded_at = now
+        for row in stored_rule_sets():
+            # tier_points[n] (1-based in Postgres) is what Tn scores
+            _stored[row.id] = RuleSet(row.id, row.name, [0.0, *row.tier_points])
+        compiled = _stored.get(rule_set)
+        if compiled is not None:
+            return compiled
+        logging.warning("unknown rule set %s, scoring as version 2", rule_set)
+    return BUILT_IN[2]
+
+
+def score(tier, rule_set):
+    return get_rule_set(rule_set).score(tier)
+
+
+def week_points(tiers, rule_set):
+    """A week's points: the best five of its days' tiers, T0 scoring nothing"""
+    return get_rule_set(rule_set).week_points(tiers)
+
+
+def total_score(checkins_this_challenge):
+    """Each challenger's points: their best five days of each week, summed.
+
+    Rows are one per challenger per day and come ordered by week. Scores are
+    added up in the same order as always so totals stay bit for bit the same.
+    """
+    if len(checkins_this_challenge) == 0:
+        return {}
+    version = checkins_this_challenge[0].rule_set
+    logging.info("Version: %s", version)
+    rule_set = get_rule_set(version)
+    # name -> week -> day tiers, with weeks in the order they come in
+    weeks_by_name = {}
+    week = run = None
+    for row in checkins_this_challenge:
+        if run is None or row.challenge_week_id != week:
+            week = row.challenge_week_id
+            run = object()
+        weeks_by_name.setdefault(row.name, {}).setdefault(run, []).append(row.max)
+    result = {
+        name: sum(rule_set.week_points(tiers) for tiers in weeks.values())
+        for name, weeks in weeks_by_name.items()
+    }
+    logging.info("Total Points: %s", result)
+    return result
+
+
+def sum_week_points(rows):
+    """Adds up challenger_week_scores rows, which come ordered by week, in the
+    same order total_score does"""
+    result = {}
+    for row in rows:
+        result[row.name] = result.get(row.name, 0) + row.points
+    logging.info("Total Points: %s", result)
+    return result
+
+
+@query(post=sum_week_points)
 def calculate_total_score(challenge_id):
-    query = """
-        select 
+    sql = """
+        select ch.name, s.points
+        from challenger_week_scores s
+        join challenge_weeks cw on cw.id = s.challenge_week_id
+        join challengers ch on ch.id = s.challenger_id
+        where
+            s.challenge_id = %s
+            and (cw.bye_week != true or cw.bye_week is null)
+            and s.points > 0
+        order by s.challenge_week_id
+    """
+    return sql, (challenge_id,)
+
+
+@query(post=total_score)
+def calculate_total_score_from_checkins(challenge_id):
+    """calculate_total_score worked out from the checkins themselves, which
+    `scores.py check` compares against"""
+    sql = """
+        select
             Max(ltrim(checkins.tier, 'T')::INT) as max,
             checkins.name,
             checkins.challenge_week_id,
@@ -49,7 +228,7 @@ def calculate_total_score(challenge_id):
             on checkins.challenge_week_id = challenge_weeks.id
         join challenges
             on challenge_weeks.challenge_id = challenges.id
-        where 
+        where
            (
                challenge_weeks.bye_week != true
                or challenge_weeks.bye_week is null
@@ -58,43 +237,59 @@ def calculate_total_score(challenge_id):
            and challenges.id = %s
            and checkins.tier != 'T0'
         group by
-            date(checkins.time at time zone 'America/New_York'),
+            checkins.local_date,
             checkins.name,
             checkins.challenge_week_id,
             challenges.rule_set
         order by checkins.challenge_week_id
     """
-    checkins_this_challenge = fetchall(query, (challenge_id, challenge_id))
-    if len(checkins_this_challenge) == 0:
-        return {}
-    version = checkins_this_challenge[0].rule_set
-    logging.info("Version: %s", version)
-    nums = [
-        {
-            "name": n.name,
-            "value": score(n.max, version),
-            "week": n.challenge_week_id,
-            "tier": n.max,
-        }
-        for n in checkins_this_challenge
+    return sql, (challenge_id, challenge_id)
+
+
+if __name__ == "__main__":
+    # Times total_score and tier scoring on a synthetic 52 week, 500
+    # challenger challenge
+    class Row(NamedTuple):
+        max: int
+        name: str
+        challenge_week_id: int
+        rule_set: int
+
+    logging.disable(logging.INFO)
+
+    # the built in rule sets score every tier, by number and by name and past
+    # their tables too, as the functions they're compiled from
+    for version, score_tier in [(1, version_1_score), (2, version_2_score)]:
+        numbers = [0.0] + [float(score_tier(n)) for n in range(1, 25)]
+        names = [float(score_tier("T%s" % n)) for n in range(25)]
+        rule_set = get_rule_set(version)
+        assert [rule_set.score(n) for n in range(25)] == numbers, version
+        assert rule_set.scores(np.arange(25)).tolist() == numbers, version
+        assert [rule_set.score("T%s" % n) for n in range(25)] == names, version
+
+    rng = random.Random(0)
+    rows = [
+        Row(rng.randint(1, 5), "challenger%s" % n, week, 2)
+        for week in range(52)
+        for n in range(500)
+        for _ in range(7)
+        if rng.random() < 0.7
     ]
-    names = set(n["name"] for n in nums)
-    weeks = [list(week) for w, week in itertools.groupby(nums, key=lambda x: x["week"])]
-    num_weeks = len(list(weeks))
-    result = {
-        n: sum(
-            round(
-                sum(
-                    sorted(
-                        (name["value"] for name in week if name["name"] == n),
-                        reverse=True,
-                    )[:5]
-                ),
-                4,
-            )
-            for week in weeks
-        )
-        for n in names
-    }
-    logging.info("Total Points: %s", result)
-    return result
+    start = time.perf_counter()
+    for _ in range(10):
+        total_score(rows)
+    print(
+        "%s rows: %.1f ms" % (len(rows), (time.perf_counter() - start) / 10 * 1000)
+    )
+
+    # and scoring the same tiers one at a time against all at once
+    rule_set = get_rule_set(2)
+    tiers = [row.max for row in rows]
+    start = time.perf_counter()
+    for tier in tiers:
+        rule_set.score(tier)
+    print("score: %.1f ms" % ((time.perf_counter() - start) * 1000))
+    tiers = np.array(tiers)
+    start = time.perf_counter()
+    rule_set.scores(tiers)
+    print("scores: %.1f ms" % ((time.perf_counter() - start) * 1000))
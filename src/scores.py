@@ -0,0 +1,224 @@
+from helpers import fetchall, query, with_psycopg
+from notifications import notify_change
+from rule_sets import (
+    calculate_total_score,
+    calculate_total_score_from_checkins,
+    week_points,
+)
+import argparse
+import itertools
+import sys
+import logging
+
+# Best tier of each day checked in (in the challenger's timezone), per
+# challenger and challenge week. Every score is built from these.
+DAY_TIERS = """
+    select
+        c.challenger,
+        c.challenge_week_id,
+        cw.challenge_id,
+        ch.rule_set,
+        c.local_date as day,
+        max(ltrim(c.tier, 'T')::int) as tier
+    from checkins c
+    join challenge_weeks cw on cw.id = c.challenge_week_id
+    join challenges ch on ch.id = cw.challenge_id
+    where c.challenger is not null and {where}
+    group by c.challenger, c.challenge_week_id, cw.challenge_id, ch.rule_set, day
+    order by c.challenger, c.challenge_week_id, day
+"""
+
+COLUMNS = (
+    "challenger_id",
+    "challenge_week_id",
+    "challenge_id",
+    "days_checked_in",
+    "best_tiers",
+    "points",
+    "capped_days",
+)
+
+UPSERT = """
+    insert into challenger_week_scores ({columns})
+    values (%s, %s, %s, %s, %s, %s, %s)
+    on conflict (challenger_id, challenge_week_id) do update set
+        challenge_id = excluded.challenge_id,
+        days_checked_in = excluded.days_checked_in,
+        best_tiers = excluded.best_tiers,
+        points = excluded.points,
+        capped_days = excluded.capped_days,
+        updated_at = now()
+""".format(
+    columns=", ".join(COLUMNS)
+)
+
+# Days each challenger counted towards the pot, as get_challenge_score used to
+# work them out: at most five a week.
+CHALLENGE_POINTS = """
+    with challenger_points as (
+        select challenger_id, sum(capped_days) as points
+        from challenger_week_scores
+        where challenge_id = %s
+        group by challenger_id
+    )
+    select p.points::numeric as points, ch.name, cc.tier
+    from challenger_points p
+    join challenger_challenges cc
+        on cc.challenger_id = p.challenger_id and cc.challenge_id = %s
+    join challengers ch on ch.id = p.challenger_id
+    where
+        cc.knocked_out = %s
+        and cc.ante > 0
+        and cc.tier != 'T0'
+    order by cc.tier
+"""
+
+
+def week_scores(day_rows):
+    """Turns DAY_TIERS rows into challenger_week_scores rows"""
+    for (challenger, week), days in itertools.groupby(
+        day_rows, key=lambda r: (r.challenger, r.challenge_week_id)
+    ):
+        days = list(days)
+        tiers = [day.tier for day in days]
+        yield (
+            challenger,
+            week,
+            days[0].challenge_id,
+            len(tiers),
+            tiers,
+            float(week_points(tiers, days[0].rule_set)),
+            min(len(tiers), 5),
+        )
+
+
+def refresh_week_score(cur, challenger_id, week_id):
+    """Recomputes one challenger's row for one week on cur's transaction.
+
+    Called after every checkin insert, mulligans included. The advisory lock
+    makes concurrent checkins for the same challenger and week take turns, so
+    whichever commits last has seen the other's checkin.
+    """
+    cur.execute("select pg_advisory_xact_lock(%s::int, %s::int)", [challenger_id, week_id])
+    cur.execute(
+        DAY_TIERS.format(where="c.challenger = %s and c.challenge_week_id = %s"),
+        [challenger_id, week_id],
+    )
+    rows = list(week_scores(cur.fetchall()))
+    if rows:
+        cur.execute(UPSERT, rows[0])
+    else:
+        cur.execute(
+            "delete from challenger_week_scores where challenger_id = %s and challenge_week_id = %s",
+            [challenger_id, week_id],
+        )
+
+
+def rebuild_scores(cur, challenge_id):
+    """Recomputes every row of a challenge from its checkins on cur's
+    transaction, returning the number of rows written"""
+    # checkins arriving meanwhile wait and then apply their own refresh
+    cur.execute("lock table challenger_week_scores in exclusive mode")
+    cur.execute(DAY_TIERS.format(where="cw.challenge_id = %s"), [challenge_id])
+    rows = list(week_scores(cur.fetchall()))
+    cur.execute(
+        "delete from challenger_week_scores where challenge_id = %s", [challenge_id]
+    )
+    with cur.copy(
+        "copy challenger_week_scores (%s) from stdin" % ", ".join(COLUMNS)
+    ) as copy:
+        for row in rows:
+            copy.write_row(row)
+    notify_change(cur, "challenger_week_scores", challenge_id=challenge_id)
+    return len(rows)
+
+
+def rebuild(challenge_id):
+    """Recomputes every row of a challenge from its checkins, in one
+    transaction. Needed after a challenge's rule set changes or checkins are
+    edited by hand. Returns the number of rows written."""
+    written = with_psycopg(lambda conn, cur: rebuild_scores(cur, challenge_id))
+    logging.info("rebuilt %s week scores for challenge %s", written, challenge_id)
+    return written
+
+
+@query()
+def stored_scores(challenge_id):
+    sql = "select {columns} from challenger_week_scores where challenge_id = %s".format(
+        columns=", ".join(COLUMNS)
+    )
+    return sql, [challenge_id]
+
+
+def differences(name, stored, expected):
+    return [
+        "%s %s: stored %s, expected %s" % (name, key, stored.get(key), expected.get(key))
+        for key in sorted(stored.keys() | expected.keys(), key=str)
+        if stored.get(key) != expected.get(key)
+    ]
+
+
+def check(challenge_id):
+    """Compares the stored scores with scores worked out from scratch,
+    returning a line per difference"""
+    expected = {
+        row[:2]: row[2:]
+        for row in week_scores(
+            fetchall(DAY_TIERS.format(where="cw.challenge_id = %s"), [challenge_id])
+        )
+    }
+    stored = {row[:2]: tuple(row[2:]) for row in stored_scores(challenge_id)}
+    problems = differences("challenger, week", stored, expected)
+
+    # and what the pages show against the queries the table replaced
+    problems += differences(
+        "total score",
+        calculate_total_score(challenge_id),
+        calculate_total_score_from_checkins(challenge_id),
+    )
+    for knocked_out in (False, True):
+        problems += differences(
+            "knocked out" if knocked_out else "challenge points",
+            {
+                (row.name, row.tier): row.points
+                for row in fetchall(
+                    CHALLENGE_POINTS, (challenge_id, challenge_id, knocked_out)
+                )
+            },
+            {
+                (row.name, row.tier): row.points
+                for row in fetchall(
+                    "select * from get_challenge_score(%s::int, %s)",
+                    (challenge_id, knocked_out),
+                )
+            },
+        )
+    return problems
+
+
+def challenge_ids(args):
+    if args.all:
+        return [row.id for row in fetchall("select id from challenges order by id")]
+    return args.challenge_id
+
+
+if __name__ == "__main__":
+    # python scores.py rebuild <challenge_id>... | --all
+    # python scores.py check <challenge_id>... | --all
+    parser = argparse.ArgumentParser(description="Maintain challenger_week_scores")
+    parser.add_argument("command", choices=["rebuild", "check"])
+    parser.add_argument("challenge_id", type=int, nargs="*")
+    parser.add_argument("--all", action="store_true", help="every challenge")
+    args = parser.parse_args()
+
+    failed = False
+    for challenge_id in challenge_ids(args):
+        if args.command == "rebuild":
+            print("challenge %s: %s rows" % (challenge_id, rebuild(challenge_id)))
+            continue
+        problems = check(challenge_id)
+        for problem in problems:
+            print("challenge %s: %s" % (challenge_id, problem))
+        print("challenge %s: %s differences" % (challenge_id, len(problems)))
+        failed = failed or bool(problems)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,289 @@
+import numpy as np
+from helpers import query
+from challenge_calendar import get_calendar
+from chart import SVG_HEADER, colors, greens, escape_attribute, escape_text
+from rule_sets import get_rule_set
+from datetime import date
+from typing import List, NamedTuple
+import logging
+
+CELL = 10
+WEEK_GAP = 4
+ROW_GAP = 2
+LABEL_WIDTH = 120
+HEADER_HEIGHT = 30
+STATS = ["Points", "Full wks", "Streak", "Best"]
+STAT_WIDTH = 60
+
+# Cell paths are written as fixed width records, "M<x> <y>h9v9h-9z" with x
+# and y zero padded to COORD_DIGITS, so a whole path is one array operation.
+# Formatting the cells of a year of 300 challengers one at a time took ten
+# times as long, more than the rest of the chart (see season_bench.py).
+COORD_DIGITS = 5
+PLACES = 10 ** np.arange(COORD_DIGITS - 1, -1, -1)
+CELL_PATH = np.frombuffer(
+    ("h%sv%sh-%sz" % (CELL - 1, CELL - 1, CELL - 1)).encode("ascii"), dtype=np.uint8
+)
+
+
+class Season(NamedTuple):
+    """A whole challenge as challengers x days arrays.
+
+    tiers holds the best tier checked in that day or -1, mulligans marks the
+    mulligan checkin's day and bye marks days in bye weeks. week_of_day maps
+    each day to its challenge week and day_in_week to its slot in that week.
+    """
+
+    challenge: tuple
+    start: date
+    names: List[str]
+    knocked_out: np.ndarray
+    tiers: np.ndarray
+    mulligans: np.ndarray
+    bye: np.ndarray
+    week_of_day: np.ndarray
+    day_in_week: np.ndarray
+    weeks: int
+
+
+class SeasonStats(NamedTuple):
+    week_counts: np.ndarray
+    week_points: np.ndarray
+    total_points: np.ndarray
+    full_weeks: np.ndarray
+    current_streak: np.ndarray
+    longest_streak: np.ndarray
+
+
+@query()
+def season_checkins(challenge_id, start, week_ids):
+    """One row per challenger with the day (counted from the challenge's start)
+    and tier of each of their checkins this challenge, plus the day of their
+    mulligan.
+
+    Days and tiers come back packed as big endian int2s so they can be read
+    straight into arrays; decoding Postgres arrays into Python lists took
+    longer than running the query. The start and week ids come from the
+    calendar so no checkin has to be joined to its week.
+    """
+    sql = """
+    with challenger_checkins as (
+      select
+        c.challenger,
+        string_agg(int2send((c.local_date - %(start)s::date)::smallint), '') as days,
+        string_agg(int2send(ltrim(c.tier, 'T')::smallint), '') as tiers
+      from checkins c
+      where c.challenge_week_id = any(%(week_ids)s)
+      group by c.challenger
+    )
+    select
+      ch.name,
+      coalesce(cc.knocked_out, false) as knocked_out,
+      coalesce(d.days, '') as days,
+      coalesce(d.tiers, '') as tiers,
+      (select c.local_date - %(start)s::date
+       from checkins c
+       where c.id = cc.mulligan) as mulligan_day
+    from challenger_challenges cc
+    join challengers ch on ch.id = cc.challenger_id
+    left join challenger_checkins d on d.challenger = ch.id
+    where cc.challenge_id = %(challenge_id)s
+    order by ch.name
+    """
+    return sql, {"challenge_id": challenge_id, "start": start, "week_ids": week_ids}
+
+
+def load_season(challenge_id):
+    calendar = get_calendar()
+    challenge = calendar.challenges_by_id[challenge_id]
+    weeks = calendar.weeks_of(challenge_id)
+    days = (challenge.end - challenge.start).days + 1
+    rows = season_checkins(challenge_id, challenge.start, [w.id for w in weeks])
+
+    counts = [len(row.tiers) // 2 for row in rows]
+    row_of = np.repeat(np.arange(len(rows)), counts)
+    day = np.frombuffer(b"".join(row.days for row in rows), dtype=">i2")
+    day = day.astype(np.intp)
+    checkin_tiers = np.frombuffer(b"".join(row.tiers for row in rows), dtype=">i2")
+    in_challenge = (day >= 0) & (day < days)
+
+    # best tier per challenger and day
+    tiers = np.full((len(rows), days), -1, dtype=np.int16)
+    np.maximum.at(
+        tiers.reshape(-1),
+        row_of[in_challenge] * days + day[in_challenge],
+        checkin_tiers[in_challenge],
+    )
+
+    mulligans = np.zeros((len(rows), days), dtype=bool)
+    for i, row in enumerate(rows):
+        if row.mulligan_day is not None and 0 <= row.mulligan_day < days:
+            mulligans[i, row.mulligan_day] = True
+
+    week_starts = np.array([(w.start - challenge.start).days for w in weeks] or [0])
+    day_numbers = np.arange(days)
+    # days before the first week are counted in it
+    week_of_day = np.clip(
+        np.searchsorted(week_starts, day_numbers, side="right") - 1, 0, None
+    )
+    day_in_week = np.clip(day_numbers - week_starts[week_of_day], 0, 6)
+    bye_weeks = np.array([bool(w.bye_week) for w in weeks] or [False])
+
+    return Season(
+        challenge,
+        challenge.start,
+        [row.name for row in rows],
+        np.array([row.knocked_out for row in rows], dtype=bool),
+        tiers,
+        mulligans,
+        bye_weeks[week_of_day],
+        week_of_day,
+        day_in_week,
+        len(week_starts),
+    )
+
+
+def runs(mask):
+    """Length of the run of True values ending at each position, per row"""
+    counts = np.cumsum(mask, axis=1)
+    resets = np.maximum.accumulate(np.where(mask, 0, counts), axis=1)
+    return counts - resets
+
+
+def season_stats(season, rule_set, today=None):
+    today = today or date.today()
+    n, days = season.tiers.shape
+    checked = season.tiers >= 0
+
+    # no checkin (-1) and T0 score nothing
+    points = get_rule_set(rule_set).scores(season.tiers)
+    points[:, season.bye] = 0
+
+    # lay days out as challengers x weeks x 7 so weekly reductions are axis ops
+    slots = season.week_of_day * 7 + season.day_in_week
+    by_week = np.zeros((n, season.weeks * 7))
+    by_week[:, slots] = points
+    by_week = by_week.reshape(n, season.weeks, 7)
+    week_points = np.round(np.sort(by_week, axis=2)[:, :, -5:].sum(axis=2), 4)
+
+    checked_by_week = np.zeros((n, season.weeks * 7), dtype=bool)
+    checked_by_week[:, slots] = checked
+    week_counts = checked_by_week.reshape(n, season.weeks, 7).sum(axis=2)
+
+    elapsed = min(max((today - season.start).days, 0), days - 1)
+    streaks = runs(checked[:, : elapsed + 1])
+    current_week = season.week_of_day[elapsed]
+    full_weeks = (week_counts[:, : current_week + 1] >= 5).sum(axis=1)
+
+    return SeasonStats(
+        week_counts,
+        week_points,
+        week_points.sum(axis=1),
+        full_weeks,
+        streaks[:, -1],
+        streaks.max(axis=1, initial=0),
+    )
+
+
+def coordinate_digits(values):
+    """ASCII digits of each value, zero padded to COORD_DIGITS"""
+    return (values[:, None] // PLACES % 10 + ord("0")).astype(np.uint8)
+
+
+def cells_path(mask, x_digits, y_digits, fill):
+    """One path drawing a cell for every True in mask"""
+    rows, days = np.nonzero(mask)
+    if not len(rows):
+        return ""
+    records = np.empty((len(rows), 2 + 2 * COORD_DIGITS + len(CELL_PATH)), np.uint8)
+    records[:, 0] = ord("M")
+    records[:, 1 : 1 + COORD_DIGITS] = x_digits[days]
+    records[:, 1 + COORD_DIGITS] = ord(" ")
+    records[:, 2 + COORD_DIGITS : 2 + 2 * COORD_DIGITS] = y_digits[rows]
+    records[:, 2 + 2 * COORD_DIGITS :] = CELL_PATH
+    return '<path d="%s" fill="%s" />' % (records.tobytes().decode("ascii"), fill)
+
+
+def tier_fill(tier):
+    return greens[min(tier + 1, len(greens) - 1)]
+
+
+def season_chart(season, stats, today=None):
+    """Renders the season as one SVG grid, a row per challenger and a column
+    per day. Cells of the same colour share a single path so the markup and
+    the time to build it stay small for year long challenges."""
+    today = today or date.today()
+    n, days = season.tiers.shape
+    grid_width = days * CELL + season.weeks * WEEK_GAP
+    width = LABEL_WIDTH + grid_width + STAT_WIDTH * len(STATS)
+    height = HEADER_HEIGHT + n * (CELL + ROW_GAP)
+
+    xs = LABEL_WIDTH + np.arange(days) * CELL + season.week_of_day * WEEK_GAP
+    ys = HEADER_HEIGHT + np.arange(n) * (CELL + ROW_GAP)
+
+    out = [SVG_HEADER.format(height=height, width=width)]
+
+    # week labels and bye week bands
+    first_days = np.flatnonzero(np.diff(season.week_of_day, prepend=-1))
+    week_lengths = np.diff(first_days, append=days)
+    for first, length in zip(first_days.tolist(), week_lengths.tolist()):
+        week = int(season.week_of_day[first])
+        out.append(
+            '<text font-size="10" x="%s" y="%s">W%s</text>'
+            % (xs[first], HEADER_HEIGHT - 8, week + 1)
+        )
+        if season.bye[first]:
+            out.append(
+                '<rect fill="%s" height="%s" width="%s" x="%s" y="%s" />'
+                % (colors[1], height - HEADER_HEIGHT, length * CELL, xs[first], HEADER_HEIGHT)
+            )
+
+    # empty cells, then one path per tier colour with mulligans on top
+    x_digits, y_digits = coordinate_digits(xs), coordinate_digits(ys)
+    out.append(cells_path(season.tiers < 0, x_digits, y_digits, colors[0]))
+    for tier in np.unique(season.tiers[season.tiers >= 0]).tolist():
+        out.append(
+            cells_path(
+                (season.tiers == tier) & ~season.mulligans,
+                x_digits,
+                y_digits,
+                tier_fill(tier),
+            )
+        )
+    out.append(cells_path(season.mulligans, x_digits, y_digits, colors[2]))
+
+    elapsed = (today - season.start).days
+    if 0 <= elapsed < days:
+        out.append(
+            '<line stroke="black" stroke-width="1" x1="%s" x2="%s" y1="%s" y2="%s" />'
+            % (xs[elapsed], xs[elapsed], HEADER_HEIGHT - 4, height)
+        )
+
+    stats_x = LABEL_WIDTH + grid_width + 10
+    for i, label in enumerate(STATS):
+        out.append(
+            '<text font-size="10" x="%s" y="%s">%s</text>'
+            % (stats_x + i * STAT_WIDTH, HEADER_HEIGHT - 8, label)
+        )
+    for r, name in enumerate(season.names):
+        text_y = ys[r] + CELL - 1
+        decoration = ' text-decoration="line-through"' if season.knocked_out[r] else ""
+        out.append(
+            '<a target="_self" xlink:href="%s"><text font-size="10"%s x="0" y="%s">%s</text></a>'
+            % (escape_attribute("/challenger/%s" % name), decoration, text_y, escape_text(name))
+        )
+        values = (
+            "%.1f" % stats.total_points[r],
+            stats.full_weeks[r],
+            stats.current_streak[r],
+            stats.longest_streak[r],
+        )
+        for i, value in enumerate(values):
+            out.append(
+                '<text font-size="10" x="%s" y="%s">%s</text>'
+                % (stats_x + i * STAT_WIDTH, text_y, value)
+            )
+
+    out.append("</svg>")
+    logging.debug("season chart: %s challengers %s days", n, days)
+    return "".join(out)
@@ -0,0 +1,113 @@
+from helpers import connection_string
+from migrate import migrate
+from query_bench import load
+from season import (
+    CELL,
+    HEADER_HEIGHT,
+    LABEL_WIDTH,
+    ROW_GAP,
+    WEEK_GAP,
+    cells_path,
+    coordinate_digits,
+    load_season,
+    season_chart,
+    season_checkins,
+    season_stats,
+)
+from challenge_calendar import get_calendar
+import numpy as np
+import argparse
+import sys
+import time
+import psycopg
+import logging
+
+
+def formatted_cells_path(mask, xs, ys, fill):
+    """cells_path with the coordinates formatted one at a time"""
+    rows, days = np.nonzero(mask)
+    if not len(rows):
+        return ""
+    d = "".join(
+        "M%05d %05dh%sv%sh-%sz" % (x, y, CELL - 1, CELL - 1, CELL - 1)
+        for x, y in zip(xs[days].tolist(), ys[rows].tolist())
+    )
+    return '<path d="%s" fill="%s" />' % (d, fill)
+
+
+def best_of(runs, f):
+    """f's result and its quickest time in ms over runs calls"""
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = f()
+        timings.append((time.perf_counter() - start) * 1000)
+    return result, min(timings)
+
+
+if __name__ == "__main__":
+    # python season_bench.py --load    # into an empty database
+    # python season_bench.py --challenge <id>
+    #
+    # Times the season page's work for a challenge, from the season_checkins
+    # query to the finished SVG, and exits 1 if it takes longer than
+    # --budget ms. --load first fills an empty local database with a year
+    # long challenge of 300 challengers (see query_bench.py). It also checks
+    # cells_path against formatting each cell's coordinates in Python and
+    # times both.
+    parser = argparse.ArgumentParser(description="Time the season page")
+    parser.add_argument("--load", action="store_true", help="load synthetic data first")
+    parser.add_argument("--challengers", type=int, default=300)
+    parser.add_argument("--weeks", type=int, default=52)
+    parser.add_argument("--challenge", type=int)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--budget", type=float, default=100)
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    challenge_id = args.challenge
+    if args.load:
+        migrate()
+        with psycopg.connect(connection_string, autocommit=True) as conn:
+            challenge_id = load(conn, args.challengers, args.weeks)
+    calendar = get_calendar()
+    challenge = (
+        calendar.challenges_by_id[challenge_id]
+        if challenge_id is not None
+        else calendar.challenges[-1]
+    )
+
+    week_ids = [w.id for w in calendar.weeks_of(challenge.id)]
+    _, query_ms = best_of(
+        args.runs, lambda: season_checkins(challenge.id, challenge.start, week_ids)
+    )
+    season, load_ms = best_of(args.runs, lambda: load_season(challenge.id))
+    stats, stats_ms = best_of(
+        args.runs, lambda: season_stats(season, challenge.rule_set)
+    )
+    svg, chart_ms = best_of(args.runs, lambda: season_chart(season, stats))
+    total = load_ms + stats_ms + chart_ms
+    n, days = season.tiers.shape
+    print("challenge %s: %s challengers, %s days" % (challenge.id, n, days))
+    print("%-22s %8.1fms" % ("season_checkins query", query_ms))
+    print("%-22s %8.1fms" % ("load_season", load_ms))
+    print("%-22s %8.1fms" % ("season_stats", stats_ms))
+    print("%-22s %8.1fms (%s KB)" % ("season_chart", chart_ms, len(svg) // 1024))
+    print("%-22s %8.1fms (budget %sms)" % ("total", total, args.budget))
+
+    xs = LABEL_WIDTH + np.arange(days) * CELL + season.week_of_day * WEEK_GAP
+    ys = HEADER_HEIGHT + np.arange(n) * (CELL + ROW_GAP)
+    x_digits, y_digits = coordinate_digits(xs), coordinate_digits(ys)
+    masks = [season.tiers < 0] + [season.tiers == tier for tier in range(11)]
+    for mask in masks:
+        assert cells_path(mask, x_digits, y_digits, "red") == formatted_cells_path(
+            mask, xs, ys, "red"
+        )
+    for name, draw, coordinates in [
+        ("cells_path", cells_path, (x_digits, y_digits)),
+        ("formatted", formatted_cells_path, (xs, ys)),
+    ]:
+        _, ms = best_of(3, lambda: [draw(mask, *coordinates, "red") for mask in masks])
+        print("%-22s %8.1fms" % (name, ms))
+
+    sys.exit(0 if total <= args.budget else 1)
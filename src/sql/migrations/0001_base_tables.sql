@@ -0,0 +1,53 @@
+-- The tables the app was built on, for setting up a fresh database. On the
+-- existing database they're already there and this does nothing.
+CREATE TABLE IF NOT EXISTS challenges (
+  name TEXT NOT NULL UNIQUE,
+  start DATE NOT NULL,
+  "end" DATE NOT NULL,
+  id SERIAL PRIMARY KEY,
+  bi_weeks INTEGER NOT NULL DEFAULT 0,
+  rule_set INTEGER NOT NULL DEFAULT 2
+);
+
+CREATE TABLE IF NOT EXISTS challenge_weeks (
+  id SERIAL PRIMARY KEY,
+  challenge_id INTEGER NOT NULL REFERENCES challenges (id),
+  week_of_year INTEGER,
+  start DATE NOT NULL,
+  "end" DATE NOT NULL,
+  green BOOLEAN,
+  bye_week BOOLEAN
+);
+
+CREATE TABLE IF NOT EXISTS challengers (
+  id SERIAL PRIMARY KEY,
+  name TEXT NOT NULL UNIQUE,
+  phone_number TEXT,
+  email_domain TEXT,
+  tz TEXT NOT NULL DEFAULT 'America/New_York',
+  bmr INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS challenger_challenges (
+  challenge_id INTEGER NOT NULL REFERENCES challenges (id),
+  challenger_id INTEGER NOT NULL REFERENCES challengers (id),
+  mulligan INTEGER,
+  knocked_out BOOLEAN NOT NULL DEFAULT FALSE,
+  ante INTEGER NOT NULL DEFAULT 0,
+  tier TEXT,
+  bi_checkins INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (challenge_id, challenger_id)
+);
+
+CREATE TABLE IF NOT EXISTS checkins (
+  id SERIAL PRIMARY KEY,
+  name TEXT,
+  time TIMESTAMPTZ NOT NULL,
+  tier TEXT NOT NULL,
+  day_of_week TEXT,
+  text TEXT,
+  challenge_week_id INTEGER REFERENCES challenge_weeks (id),
+  challenger INTEGER REFERENCES challengers (id),
+  tz TEXT,
+  UNIQUE (challenger, time)
+);
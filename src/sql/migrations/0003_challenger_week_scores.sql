@@ -0,0 +1,25 @@
+-- One row per challenger per challenge week they checked in, kept up to date
+-- by insert_checkin. migrate.py fills it in after creating it (see
+-- REBUILDS_SCORES); rebuild a challenge with `python src/scores.py rebuild`.
+CREATE TABLE IF NOT EXISTS challenger_week_scores (
+  challenger_id INTEGER NOT NULL,
+  challenge_week_id INTEGER NOT NULL,
+  challenge_id INTEGER NOT NULL,
+  -- distinct days with any checkin, T0 included: New York days when this
+  -- was created, the checkins' local_date since 0006
+  days_checked_in SMALLINT NOT NULL,
+  -- best tier of each of those days, in date order
+  best_tiers SMALLINT[] NOT NULL,
+  -- best five days' points under the challenge's rule set
+  points DOUBLE PRECISION NOT NULL,
+  -- LEAST(days_checked_in, 5), what get_challenge_score counted
+  capped_days SMALLINT NOT NULL,
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  PRIMARY KEY (challenger_id, challenge_week_id)
+);
+
+CREATE INDEX IF NOT EXISTS challenger_week_scores_challenge
+  ON challenger_week_scores (challenge_id, challenge_week_id);
+
+CREATE INDEX IF NOT EXISTS challenger_week_scores_week
+  ON challenger_week_scores (challenge_week_id);
@@ -0,0 +1,9 @@
+-- Rule sets beyond the built in versions 1 and 2 (see src/rule_sets.py), for
+-- challenges.rule_set to refer to. tier_points[n] is what a Tn day scores; T0
+-- always scores nothing and tiers past the end score as the last one. Rows are
+-- cached by the app, so add a new rule set rather than editing one in use.
+CREATE TABLE IF NOT EXISTS rule_sets (
+  id INTEGER PRIMARY KEY CHECK (id > 2),
+  name TEXT NOT NULL,
+  tier_points DOUBLE PRECISION[] NOT NULL CHECK (cardinality(tier_points) > 0)
+);
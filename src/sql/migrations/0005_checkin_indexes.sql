@@ -0,0 +1,29 @@
+-- Indexes for the queries behind every page view. `python src/query_bench.py`
+-- shows how each of them plans.
+
+-- A week's checkins per challenger and weekday, latest first: week_view's
+-- DISTINCT ON and checkins_this_week's max time per day read it in order, and
+-- challenge_validators counts a challenge's checkins from it without touching
+-- the table.
+CREATE INDEX IF NOT EXISTS checkins_week_challenger_day_time
+  ON checkins (challenge_week_id, challenger, day_of_week, time DESC)
+  INCLUDE (id, tier);
+
+-- Days in New York time, which every score groups checkins by
+CREATE INDEX IF NOT EXISTS checkins_week_challenger_ny_date
+  ON checkins (
+    challenge_week_id,
+    challenger,
+    date(time AT TIME ZONE 'America/New_York')
+  )
+  INCLUDE (tier);
+
+-- The latest checkin, shown on every week
+CREATE INDEX IF NOT EXISTS checkins_time ON checkins (time);
+
+CREATE INDEX IF NOT EXISTS challenge_weeks_challenge
+  ON challenge_weeks (challenge_id, start);
+
+-- Looking up who sent an SMS or email
+CREATE INDEX IF NOT EXISTS challengers_phone_number
+  ON challengers (phone_number);
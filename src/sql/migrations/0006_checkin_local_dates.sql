@@ -0,0 +1,75 @@
+-- The day and ISO week each checkin falls on where the challenger was, worked
+-- out once when it's written instead of in every query. checkins.tz is the
+-- challenger's timezone at the time; adding the columns fills them in for
+-- existing rows. migrate.py rebuilds every challenge's scores afterwards,
+-- since they were grouped by New York days before.
+ALTER TABLE checkins
+  ADD COLUMN IF NOT EXISTS local_date DATE GENERATED ALWAYS AS (
+    (time AT TIME ZONE coalesce(tz, 'America/New_York'))::date
+  ) STORED,
+  ADD COLUMN IF NOT EXISTS iso_week SMALLINT GENERATED ALWAYS AS (
+    extract(week FROM time AT TIME ZONE coalesce(tz, 'America/New_York'))::smallint
+  ) STORED,
+  ADD COLUMN IF NOT EXISTS iso_year SMALLINT GENERATED ALWAYS AS (
+    extract(isoyear FROM time AT TIME ZONE coalesce(tz, 'America/New_York'))::smallint
+  ) STORED;
+
+DROP INDEX IF EXISTS checkins_week_challenger_ny_date;
+
+CREATE INDEX IF NOT EXISTS checkins_week_challenger_local_date
+  ON checkins (challenge_week_id, challenger, local_date)
+  INCLUDE (tier);
+
+CREATE INDEX IF NOT EXISTS checkins_challenger_local_date
+  ON checkins (challenger, local_date);
+
+CREATE OR REPLACE FUNCTION get_challenge_score(challenge_id_input INTEGER, knocked_out_input BOOLEAN)
+returns table(
+  points numeric,
+  name text,
+  tier text
+)
+language plpgsql as $$
+BEGIN
+   RETURN Query
+   SELECT
+      SUM(q.count),
+      q.name,
+      q.tier
+   FROM
+      (
+         SELECT
+            c.iso_year,
+            c.iso_week,
+            c.name,
+            cc.tier as tier,
+            LEAST(COUNT(distinct c.local_date), 5) as count
+         FROM
+            checkins c
+            join
+               challenge_weeks cw
+               on c.challenge_week_id = cw.id
+               and cw.challenge_id = challenge_id_input
+            join
+               challenger_challenges cc
+               on c.challenger = cc.challenger_id
+               and cc.challenge_id = challenge_id_input
+         WHERE
+            cc.knocked_out = knocked_out_input
+            AND cc.ante > 0
+            and cc.tier != 'T0'
+         GROUP BY
+            c.iso_year,
+            c.iso_week,
+            c.name,
+            cc.tier
+      )
+      as q
+   group by
+      q.name,
+      q.tier
+   order by
+      q.tier;
+end
+;
+$$ ;
@@ -0,0 +1,26 @@
+-- insert_checkin and the import skip checkins already there with
+-- ON CONFLICT (challenger, time), which needs a unique index on those columns.
+-- 0001 only declares it for fresh databases, so drop any repeats, keeping the
+-- first one inserted, and add it where it's missing. A mulligan on a repeat
+-- is moved to the checkin that's kept. migrate.py rebuilds scores afterwards
+-- in case a repeat had a different tier.
+WITH repeats AS (
+  SELECT id, kept
+  FROM (
+    SELECT id, min(id) OVER (PARTITION BY challenger, time) AS kept
+    FROM checkins
+    WHERE challenger IS NOT NULL
+  ) ranked
+  WHERE id <> kept
+), remapped AS (
+  UPDATE challenger_challenges cc
+  SET mulligan = r.kept
+  FROM repeats r
+  WHERE cc.mulligan = r.id
+)
+DELETE FROM checkins c
+USING repeats r
+WHERE c.id = r.id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS checkins_challenger_time_key
+  ON checkins (challenger, time);
@@ -0,0 +1,9 @@
+-- A week's checkins per challenger and local date, latest first: week_view's
+-- DISTINCT ON reads it in order without touching the table, and the scores'
+-- per day tiers read its leading columns. It replaces the local_date index
+-- from 0006, which didn't have the time.
+CREATE INDEX IF NOT EXISTS checkins_week_challenger_local_date_time
+  ON checkins (challenge_week_id, challenger, local_date, time DESC)
+  INCLUDE (id, tier, tz);
+
+DROP INDEX IF EXISTS checkins_week_challenger_local_date;
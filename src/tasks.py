@@ -1,11 +1,15 @@
 from huey import crontab, SqliteHuey
 from green import determine_if_green
 from mulligan import check_last_week_for_mulligan_necessity, insert_mulligan_for
+import ingest
+import reclassify
 import logging
+import os
 
 logging.basicConfig(level="DEBUG")
 
-huey = SqliteHuey()
+# Shared with the web container, which enqueues drain_inbound
+huey = SqliteHuey(filename=os.environ.get("HUEY_DB", "huey.db"))
 
 
 @huey.task()
@@ -14,6 +18,28 @@ def example_task(n):
     return n
 
 
+# Retried in case another drain held the lock while the message was queued
+@huey.task(retries=3, retry_delay=2)
+@huey.lock_task("drain-inbound")
+def drain_inbound():
+    """Classifies and inserts the checkins the webhooks have queued"""
+    logging.info("INGEST: drained %s", ingest.drain())
+
+
+# Picks up retries as they come due and anything queued without a task
+@huey.periodic_task(crontab(minute="*"))
+@huey.lock_task("drain-inbound")
+def drain_inbound_periodically():
+    logging.info("INGEST: drained %s", ingest.drain())
+    ingest.prune()
+
+
+@huey.task()
+def reclassify_checkins(challenge_id, dry_run=True, delete=False):
+    """reclassify.py for one challenge, for running from the web container"""
+    return reclassify.reclassify(challenge_id, dry_run=dry_run, delete=delete)
+
+
 @huey.periodic_task(crontab(hour="8", day="1"))
 def is_green_week():
     print("Determining if green")
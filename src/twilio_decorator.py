@@ -1,19 +1,23 @@
 from flask import abort, request
-from functools import wraps
+from functools import lru_cache, wraps
 from twilio.request_validator import RequestValidator
 import os
 import logging
 
 
+@lru_cache(maxsize=1)
+def request_validator(token):
+    """One validator for every request; it only holds the auth token"""
+    return RequestValidator(token)
+
+
 # forked from https://www.twilio.com/docs/usage/tutorials/how-to-secure-your-flask-app-by-validating-incoming-twilio-requests
 def twilio_request(f):
     """Validates that incoming requests genuinely originated from Twilio"""
 
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        # Create an instance of the RequestValidator class
-        token = os.environ.get("TWILIO_AUTH_TOKEN")
-        validator = RequestValidator(token)
+        validator = request_validator(os.environ.get("TWILIO_AUTH_TOKEN"))
 
         # Validate the request using its URL, GET data,
         # and X-TWILIO-SIGNATURE header